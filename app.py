@@ -5,6 +5,19 @@ from pathlib import Path
 import streamlit as st
 
 from sorawm.core import SoraWM
+from sorawm.schemas import EncodeOptions, EncodeProfile
+
+X264_PRESETS = [
+    "ultrafast",
+    "superfast",
+    "veryfast",
+    "faster",
+    "fast",
+    "medium",
+    "slow",
+    "slower",
+    "veryslow",
+]
 
 
 def main():
@@ -34,6 +47,31 @@ def main():
         st.success(f"✅ Uploaded: {uploaded_file.name}")
         st.video(uploaded_file)
 
+        encode_profile = st.selectbox(
+            "Encoder profile",
+            options=list(EncodeProfile),
+            format_func=lambda profile: profile.value.capitalize(),
+            help="Fast encodes several times quicker for a slightly larger file",
+        )
+        with st.expander("Encoder options"):
+            preset = st.selectbox(
+                "Preset",
+                options=[None, *X264_PRESETS],
+                format_func=lambda preset: preset or "Profile default",
+                help="libx264 speed/size trade-off",
+            )
+            crf = st.number_input(
+                "CRF",
+                min_value=0,
+                max_value=51,
+                value=None,
+                step=1,
+                help="Constant quality, lower is better, replaces the bitrate target",
+            )
+            bitrate = st.text_input(
+                "Bitrate", help="Target video bitrate, e.g. 4M, takes priority over CRF"
+            )
+
         # Process button
         if st.button("🚀 Remove Watermark", type="primary", use_container_width=True):
             with tempfile.TemporaryDirectory() as tmp_dir:
@@ -59,11 +97,19 @@ def main():
                         elif progress < 95:
                             status_text.text(f"🧹 Removing watermarks... {progress}%")
                         else:
-                            status_text.text(f"🎵 Merging audio... {progress}%")
+                            status_text.text(f"🎬 Finalizing video... {progress}%")
 
                     # Run the watermark removal with progress callback
                     st.session_state.sora_wm.run(
-                        input_path, output_path, progress_callback=update_progress
+                        input_path,
+                        output_path,
+                        progress_callback=update_progress,
+                        encode_options=EncodeOptions.from_profile(
+                            encode_profile,
+                            preset=preset,
+                            crf=crf,
+                            bitrate=bitrate or None,
+                        ),
                     )
 
                     # Complete the progress bar
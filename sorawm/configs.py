@@ -7,6 +7,37 @@ RESOURCES_DIR = ROOT / "resources"
 WATER_MARK_TEMPLATE_IMAGE_PATH = RESOURCES_DIR / "watermark_template.png"
 
 WATER_MARK_DETECT_YOLO_WEIGHTS = RESOURCES_DIR / "best.pt"
+# onnx export of the yolo weights, written once by the "onnx" detector backend
+WATER_MARK_DETECT_ONNX_WEIGHTS = WATER_MARK_DETECT_YOLO_WEIGHTS.with_suffix(".onnx")
+
+# yolo detector backend: "torch" runs the weights through ultralytics, "onnx" runs
+# their onnx export with onnxruntime on the cpu
+DETECT_BACKEND = "torch"
+# number of frames sent to the yolo detector in one forward pass
+DETECT_BATCH_SIZE = 8
+# fallback input size of the yolo detector, when the weights do not record one
+DETECT_IMGSZ = 640
+# confidence threshold of the onnx backend, the ultralytics default
+DETECT_CONF = 0.25
+
+# candidate watermark regions for roi detection, (x1, y1, x2, y2) in fractions of the frame
+DETECT_ROIS = [
+    (0.0, 0.0, 0.35, 0.25),  # top left
+    (0.65, 0.0, 1.0, 0.25),  # top right
+    (0.0, 0.375, 0.35, 0.625),  # middle left
+    (0.65, 0.375, 1.0, 0.625),  # middle right
+    (0.0, 0.75, 0.35, 1.0),  # bottom left
+    (0.65, 0.75, 1.0, 1.0),  # bottom right
+]
+# a learned roi is a hit bbox grown by this ratio of its size on every side
+DETECT_ROI_EXPAND = 1.0
+DETECT_MAX_LEARNED_ROIS = 6
+# a roi hit within this many pixels of a crop border inside the frame may be a
+# truncated watermark, it counts as a miss and the next region is tried
+DETECT_ROI_BORDER_MARGIN = 2
+
+# keyframe detection: two sampled bboxes with at least this iou belong to the same segment
+DETECT_KEYFRAME_IOU = 0.5
 
 OUTPUT_DIR = ROOT / "output"
 
@@ -14,6 +45,45 @@ OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
 
 
 DEFAULT_WATERMARK_REMOVE_MODEL = "lama"
+# inference backend of the remove model on the cpu, "torch", "torchscript" (frozen
+# and optimized for inference) or "onnx" (exported once, run with onnxruntime),
+# and its intra and inter op threads, 0 keeps the runtime default. The torch thread
+# pools are process wide, counts set here apply to the whole process. The fourier
+# convolutions of lama have no onnx export, `WaterMarkCleaner` refuses "onnx" for it
+CLEAN_BACKEND = "torch"
+CLEAN_INTRA_OP_THREADS = 0
+CLEAN_INTER_OP_THREADS = 0
+# context margin in pixels kept around the watermark bbox when inpainting a crop
+CLEAN_CROP_MARGIN = 128
+# number of consecutive frames whose same shaped crops are inpainted in one forward
+CLEAN_BATCH_SIZE = 8
+# patch cache: a frame whose context ring, shrunk to a `PATCH_CACHE_THUMBNAIL` square
+# gray thumbnail, is within `PATCH_CACHE_TOLERANCE` gray levels of a cached one at
+# every pixel reuses that inpainted patch
+PATCH_CACHE_THUMBNAIL = 32
+PATCH_CACHE_TOLERANCE = 4.0
+# temporal clean: the fill of the previous frame is warped with optical flow onto
+# the next one, while the warped context differs from the frame by at most
+# `TEMPORAL_RESIDUAL_THRESHOLD` gray levels on average, and the model inpaints
+# again at least every `TEMPORAL_KEYFRAME_INTERVAL` frames
+TEMPORAL_KEYFRAME_INTERVAL = 12
+TEMPORAL_RESIDUAL_THRESHOLD = 6.0
+
+# bbox imputation: a change point is a shift of the mean bbox center between the
+# `IMPUTE_BKPS_WINDOW` frames before and after it, of at least `IMPUTE_BKPS_MIN_SHIFT`
+# pixels and `IMPUTE_BKPS_NOISE_Z` times the noise of such a windowed mean. Change
+# points are at least a window apart, shorter segments merge into a neighbour
+IMPUTE_BKPS_WINDOW = 15
+IMPUTE_BKPS_MIN_SHIFT = 8.0
+IMPUTE_BKPS_NOISE_Z = 5.0
+# first differences the streaming change point detector estimates the noise from
+IMPUTE_BKPS_NOISE_HISTORY = 1024
+
+# frames buffered between the decoder, inference and encoder threads of SoraWM.run
+PIPELINE_QUEUE_SIZE = 16
+# SoraWM.run_parallel splits a video into this many keyframe aligned chunks per
+# worker, so a slow chunk does not leave the other workers idle at the end
+PARALLEL_CHUNKS_PER_WORKER = 2
 
 WORKING_DIR = ROOT / "working_dir"
 WORKING_DIR.mkdir(exist_ok=True, parents=True)
@@ -25,3 +95,35 @@ DATA_PATH = ROOT / "data"
 DATA_PATH.mkdir(exist_ok=True, parents=True)
 
 SQLITE_PATH = DATA_PATH / "db.sqlite3"
+
+# web server: tasks run in this many worker processes, each holding its own models,
+# with `SERVER_WORKER_THREADS` cpu threads, 0 shares the cores evenly among them
+SERVER_NUM_WORKERS = 1
+SERVER_WORKER_THREADS = 0
+# a worker process that died is restarted after `SERVER_RESTART_BACKOFF_SECONDS`,
+# doubled after every failed restart up to `SERVER_RESTART_MAX_BACKOFF_SECONDS`. On
+# shutdown the worker processes get `SERVER_SHUTDOWN_TIMEOUT_SECONDS` to exit once
+# terminated before they are killed
+SERVER_RESTART_BACKOFF_SECONDS = 1.0
+SERVER_RESTART_MAX_BACKOFF_SECONDS = 60.0
+SERVER_SHUTDOWN_TIMEOUT_SECONDS = 10.0
+# task progress is pushed to subscribers from memory, the latest percentage of every
+# task is written to the database in one batched update every
+# `PROGRESS_FLUSH_SECONDS`, and idle progress event streams send a keep alive
+# comment every `SSE_KEEPALIVE_SECONDS`
+PROGRESS_FLUSH_SECONDS = 5.0
+SSE_KEEPALIVE_SECONDS = 15.0
+# uploads are streamed to disk in chunks of this many bytes
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# chunk size of the resumable upload protocol, the client sends chunks of this size
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+# largest resumable upload, a larger declared size is refused at creation
+UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024
+# resumable uploads nothing was written to for this long are removed
+UPLOAD_TTL_SECONDS = 24 * 3600
+
+# per video detection results, keyed by the video and detector weights hashes and the
+# detection and imputation settings, the least recently used entries go beyond
+# `DETECTION_CACHE_MAX_BYTES` on disk
+DETECTION_CACHE_DIR = DATA_PATH / "detection_cache"
+DETECTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
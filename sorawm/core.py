@@ -1,189 +1,767 @@
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import suppress
+from itertools import batched
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator
 
 import ffmpeg
 import numpy as np
+import torch
 from loguru import logger
 from tqdm import tqdm
 
-from sorawm.utils.video_utils import VideoLoader
-from sorawm.watermark_cleaner import WaterMarkCleaner
+from sorawm.configs import (
+    CLEAN_BACKEND,
+    CLEAN_BATCH_SIZE,
+    DETECT_BACKEND,
+    DETECT_BATCH_SIZE,
+    DETECT_KEYFRAME_IOU,
+    IMPUTE_BKPS_MIN_SHIFT,
+    IMPUTE_BKPS_NOISE_HISTORY,
+    IMPUTE_BKPS_NOISE_Z,
+    IMPUTE_BKPS_WINDOW,
+    PARALLEL_CHUNKS_PER_WORKER,
+    PIPELINE_QUEUE_SIZE,
+    WATER_MARK_DETECT_YOLO_WEIGHTS,
+)
+from sorawm.schemas import CleanReport, EncodeOptions
+from sorawm.utils.cache_utils import DetectionCache
+from sorawm.utils.detection_utils import keyframe_detect
+from sorawm.utils.pipeline_utils import ThreadedWriter, prefetch
+from sorawm.utils.video_utils import (
+    X264_PROFILES,
+    VideoLoader,
+    can_copy_audio,
+    concat_video_segments,
+    copy_video_segment,
+    get_keyframe_indices,
+    split_at_keyframes,
+)
+from sorawm.watermark_cleaner import WaterMarkCleaner, paste_patch
 from sorawm.watermark_detector import SoraWaterMarkDetector
 from sorawm.utils.imputation_utils import (
-    find_2d_data_bkps,
-    get_interval_average_bbox,
-    find_idxs_interval,
+    StreamingBkpsDetector,
+    impute_missed_bboxes,
 )
 
 
 class SoraWM:
-    def __init__(self):
-        self.detector = SoraWaterMarkDetector()
-        self.cleaner = WaterMarkCleaner()
+    def __init__(
+        self,
+        detect_batch_size: int = DETECT_BATCH_SIZE,
+        use_roi_detection: bool = False,
+        detect_backend: str = DETECT_BACKEND,
+        detect_keyframe_interval: int | None = None,
+        clean_batch_size: int = CLEAN_BATCH_SIZE,
+        copy_clean_gops: bool = False,
+        use_detection_cache: bool = True,
+        patch_cache_size: int = 0,
+        temporal_clean: bool = False,
+        clean_backend: str = CLEAN_BACKEND,
+    ):
+        self.detect_batch_size = detect_batch_size
+        self.clean_batch_size = clean_batch_size
+        # stream copy the GOPs without any watermark instead of re-encoding them
+        self.copy_clean_gops = copy_clean_gops
+        # when set, yolo only runs every `detect_keyframe_interval` frames and
+        # where two consecutive samples disagree, see `keyframe_detect`
+        self.detect_keyframe_interval = detect_keyframe_interval
+        self.detector = SoraWaterMarkDetector(
+            use_roi=use_roi_detection, backend=detect_backend
+        )
+        # reuse of inpainted patches on static shots, see `PatchCache`, and in
+        # temporal mode the model only inpaints keyframes of each bbox segment
+        # while the frames in between get the previous fill warped by optical flow
+        self.cleaner = WaterMarkCleaner(
+            patch_cache_size=patch_cache_size,
+            temporal=temporal_clean,
+            backend=clean_backend,
+        )
+        # detection results of videos seen before, a rerun of the same file with
+        # other clean or encode settings skips the detection pass
+        self.detection_cache = DetectionCache() if use_detection_cache else None
 
     def run(
         self,
         input_video_path: Path,
         output_video_path: Path,
         progress_callback: Callable[[int], None] | None = None,
-    ):
-        input_video_loader = VideoLoader(input_video_path)
+        encode_options: EncodeOptions | None = None,
+    ) -> CleanReport:
+        input_video_loader = VideoLoader(
+            input_video_path, ring_size=self._frame_ring_size()
+        )
         output_video_path.parent.mkdir(parents=True, exist_ok=True)
-        width = input_video_loader.width
-        height = input_video_loader.height
-        fps = input_video_loader.fps
-        total_frames = input_video_loader.total_frames
+        if encode_options is None:
+            encode_options = EncodeOptions()
 
-        temp_output_path = output_video_path.parent / f"temp_{output_video_path.name}"
-        output_options = {
-            "pix_fmt": "yuv420p",
-            "vcodec": "libx264",
-            "preset": "slow",
-        }
+        # Only per-frame detection results are kept between the two passes, the
+        # frames themselves are decoded again for the clean pass, so the peak
+        # memory does not grow with the video length.
+        cache_key = self._detection_cache_key(input_video_path)
+        bboxes = self._load_cached_bboxes(cache_key)
+        if bboxes is not None:
+            if progress_callback:
+                progress_callback(50)
+        else:
+            # the change points of the bbox centers are found while detecting, in
+            # bounded memory, so imputation has no extra pass over the whole video
+            bkps_detector = StreamingBkpsDetector()
+            detected_bboxes, confidences = self.detect_watermarks(
+                input_video_loader, progress_callback, bkps_detector
+            )
+            bboxes = impute_missed_bboxes(
+                detected_bboxes, bkps=bkps_detector.finalize()
+            )
+            if cache_key:
+                self.detection_cache.save(
+                    cache_key, detected_bboxes, confidences, bboxes
+                )
+        # the probed frame count is only an estimate for some containers
+        num_frames = len(bboxes)
+
+        report = CleanReport.from_bboxes(bboxes)
+        logger.info(
+            f"{report.no_watermark_frames}/{report.total_frames} frames "
+            "have no watermark"
+        )
+
+        def _clean_progress(done: int):
+            # 50% - 95%
+            if progress_callback:
+                progress_callback(50 + int((done / max(num_frames, 1)) * 45))
 
-        if input_video_loader.original_bitrate:
-            output_options["video_bitrate"] = str(
-                int(int(input_video_loader.original_bitrate) * 1.2)
+        segments = (
+            self._plan_copy_segments(input_video_loader, bboxes, encode_options)
+            if self.copy_clean_gops
+            else None
+        )
+        if segments:
+            report.copied_frames = self._write_segments(
+                input_video_loader,
+                bboxes,
+                segments,
+                output_video_path,
+                encode_options,
+                _clean_progress,
+            )
+            logger.info(
+                f"Stream copied {report.copied_frames}/{num_frames} frames "
+                f"in {sum(copy for _, _, copy in segments)} segments"
             )
         else:
-            output_options["crf"] = "18"
+            self.clean_video(
+                input_video_loader,
+                bboxes,
+                output_video_path,
+                encode_options,
+                _clean_progress,
+            )
 
-        process_out = (
+        # 95% - 99%
+        if progress_callback:
+            progress_callback(95)
+
+        logger.info(f"Saved no watermark video with audio at: {output_video_path}")
+
+        if progress_callback:
+            progress_callback(99)
+        return report
+
+    def run_parallel(
+        self,
+        input_video_path: Path,
+        output_video_path: Path,
+        workers: int | None = None,
+        progress_callback: Callable[[int], None] | None = None,
+        encode_options: EncodeOptions | None = None,
+    ) -> CleanReport:
+        """`run` spread over a pool of `workers` processes, each with its own models
+
+        The video is cut at keyframes into chunks, detection runs per chunk and the
+        missed bboxes are imputed over the whole video, so the result does not
+        depend on the chunk borders. The chunks are then cleaned and encoded in
+        parallel, and joined with the concat demuxer without re-encoding.
+        """
+        workers = workers or os.cpu_count() or 1
+        input_video_loader = VideoLoader(input_video_path)
+        output_video_path.parent.mkdir(parents=True, exist_ok=True)
+        if encode_options is None:
+            encode_options = EncodeOptions()
+
+        keyframes = get_keyframe_indices(input_video_path, input_video_loader.fps)
+        chunks = split_at_keyframes(
+            keyframes,
+            input_video_loader.total_frames,
+            workers * PARALLEL_CHUNKS_PER_WORKER,
+        )
+        workers = min(workers, len(chunks))
+        if workers == 1:
+            return self.run(
+                input_video_path, output_video_path, progress_callback, encode_options
+            )
+        logger.info(f"Processing {len(chunks)} chunks on {workers} workers")
+        total_frames = max(input_video_loader.total_frames, 1)
+        cache_key = self._detection_cache_key(input_video_path)
+        bboxes = self._load_cached_bboxes(cache_key)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            # the parent holds models and pipeline threads, workers start clean
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_parallel_worker,
+            initargs=(
+                self._worker_kwargs(),
+                max((os.cpu_count() or 1) // workers, 1),
+            ),
+        ) as executor:
+            if bboxes is not None:
+                chunk_lengths = [
+                    (end if end is not None else len(bboxes)) - start
+                    for start, end in chunks
+                ]
+                if progress_callback:
+                    progress_callback(50)
+            else:
+                bboxes, chunk_lengths = self._detect_chunks(
+                    executor,
+                    input_video_path,
+                    chunks,
+                    total_frames,
+                    progress_callback,
+                    cache_key,
+                )
+            num_frames = len(bboxes)
+            report = CleanReport.from_bboxes(bboxes)
+            logger.info(
+                f"{report.no_watermark_frames}/{report.total_frames} frames "
+                "have no watermark"
+            )
+
+            with tempfile.TemporaryDirectory(dir=output_video_path.parent) as tmp_dir:
+                segment_paths = []
+                clean_futures = {}
+                offset = 0
+                for chunk_idx, ((start, end), chunk_frames) in enumerate(
+                    zip(chunks, chunk_lengths)
+                ):
+                    if not chunk_frames:
+                        continue
+                    segment_path = Path(tmp_dir) / f"chunk_{chunk_idx:05d}.ts"
+                    segment_paths.append(segment_path)
+                    future = executor.submit(
+                        _clean_chunk,
+                        input_video_path,
+                        start,
+                        end,
+                        bboxes[offset : offset + chunk_frames],
+                        segment_path,
+                        encode_options,
+                    )
+                    clean_futures[future] = chunk_frames
+                    offset += chunk_frames
+
+                frames_done = 0
+                for future in as_completed(clean_futures):
+                    future.result()
+                    frames_done += clean_futures[future]
+                    # 50% - 95%
+                    if progress_callback:
+                        progress_callback(
+                            50 + int((frames_done / max(num_frames, 1)) * 45)
+                        )
+
+                concat_video_segments(
+                    segment_paths,
+                    output_video_path,
+                    input_video_path,
+                    input_video_loader.audio_codec,
+                )
+
+        if progress_callback:
+            progress_callback(95)
+
+        logger.info(f"Saved no watermark video with audio at: {output_video_path}")
+
+        if progress_callback:
+            progress_callback(99)
+        return report
+
+    def detect_watermarks(
+        self,
+        input_video_loader: VideoLoader,
+        progress_callback: Callable[[int], None] | None = None,
+        bkps_detector: StreamingBkpsDetector | None = None,
+    ) -> tuple[list[tuple[int, int, int, int] | None], list[float | None]]:
+        """detection pass, the bbox and confidence of every frame, None when missed
+
+        The bbox centers are fed to `bkps_detector` as they come, when given.
+        """
+        total_frames = input_video_loader.total_frames
+        bboxes = []
+        confidences = []
+
+        logger.debug(
+            f"total frames: {total_frames}, fps: {input_video_loader.fps}, "
+            f"width: {input_video_loader.width}, height: {input_video_loader.height}"
+        )
+        self.detector.reset_learned_rois()
+        frame_iter = tqdm(
+            prefetch(input_video_loader, PIPELINE_QUEUE_SIZE),
+            total=total_frames,
+            desc="Detect watermarks",
+        )
+        # frames waiting for their detection result, their buffers go back to
+        # the loader pool as soon as the result is known
+        pending_frames = deque()
+
+        def _track_pending(frames):
+            for frame in frames:
+                pending_frames.append(frame)
+                yield frame
+
+        for idx, (bbox, confidence) in enumerate(
+            self._iter_detections(_track_pending(frame_iter))
+        ):
+            input_video_loader.release(pending_frames.popleft())
+            bboxes.append(bbox)
+            confidences.append(confidence)
+            if bkps_detector is not None:
+                bkps_detector.update(
+                    (int((bbox[0] + bbox[2]) / 2), int((bbox[1] + bbox[3]) / 2))
+                    if bbox is not None
+                    else None
+                )
+            # 10% - 50%
+            if progress_callback and idx % 10 == 0:
+                progress = 10 + int((idx / max(total_frames, 1)) * 40)
+                progress_callback(progress)
+        return bboxes, confidences
+
+    def clean_video(
+        self,
+        input_video_loader: VideoLoader,
+        bboxes: list[tuple[int, int, int, int] | None],
+        output_video_path: Path,
+        encode_options: EncodeOptions,
+        on_progress: Callable[[int], None] | None = None,
+        with_audio: bool = True,
+        output_format: str | None = None,
+    ):
+        """clean pass, inpaint `bboxes` on the frames of the loader and encode them
+
+        `bboxes` is indexed from the first frame of the loader, `on_progress` is
+        called with the number of frames done every 10 frames.
+        """
+        width = input_video_loader.width
+        height = input_video_loader.height
+        num_frames = len(bboxes)
+        output_options = encode_options.to_ffmpeg_kwargs(
+            input_video_loader.original_bitrate
+        )
+        if output_format:
+            output_options["format"] = output_format
+
+        # the encoder muxes the source audio itself, stream copied when the
+        # output container supports its codec, so no temporary video is written
+        output_streams = [
             ffmpeg.input(
                 "pipe:",
                 format="rawvideo",
                 pix_fmt="bgr24",
                 s=f"{width}x{height}",
-                r=fps,
+                r=input_video_loader.fps,
+            ).video
+        ]
+        if with_audio and input_video_loader.audio_codec:
+            output_streams.append(
+                ffmpeg.input(str(input_video_loader.video_path)).audio
             )
-            .output(str(temp_output_path), **output_options)
+            if can_copy_audio(input_video_loader.audio_codec, output_video_path):
+                output_options["acodec"] = "copy"
+            else:
+                output_options["acodec"] = "aac"
+
+        process_out = (
+            ffmpeg.output(*output_streams, str(output_video_path), **output_options)
             .overwrite_output()
             .global_args("-loglevel", "error")
             .run_async(pipe_stdin=True)
         )
 
-        frame_and_mask = {}
-        detect_missed = []
-        bbox_centers = []
-        bboxes = []
-
-        logger.debug(
-            f"total frames: {total_frames}, fps: {fps}, width: {width}, height: {height}"
+        # decoding, inpainting and encoding overlap: ffmpeg decodes into a
+        # bounded queue on one thread and the encoder is fed from another one
+        frame_iter = tqdm(
+            prefetch(input_video_loader, PIPELINE_QUEUE_SIZE),
+            total=num_frames,
+            desc="Remove watermarks",
         )
-        for idx, frame in enumerate(
-            tqdm(input_video_loader, total=total_frames, desc="Detect watermarks")
-        ):
-            detection_result = self.detector.detect(frame)
-            if detection_result["detected"]:
-                frame_and_mask[idx] = {"frame": frame, "bbox": detection_result["bbox"]}
-                x1, y1, x2, y2 = detection_result["bbox"]
-                bbox_centers.append((int((x1 + x2) / 2), int((y1 + y2) / 2)))
-                bboxes.append((x1, y1, x2, y2))
 
-            else:
-                frame_and_mask[idx] = {"frame": frame, "bbox": None}
-                detect_missed.append(idx)
-                bbox_centers.append(None)
-                bboxes.append(None)
-            # 10% - 50%
-            if progress_callback and idx % 10 == 0:
-                progress = 10 + int((idx / total_frames) * 40)
-                progress_callback(progress)
+        def _write_frame(frame: np.ndarray):
+            process_out.stdin.write(memoryview(frame))
+            input_video_loader.release(frame)
 
-        logger.debug(f"detect missed frames: {detect_missed}")
-        # logger.debug(f"bbox centers: \n{bbox_centers}")
-        if detect_missed:
-            # 1. find the bkps of the bbox centers
-            bkps = find_2d_data_bkps(bbox_centers)
-            # add the start and end position, to form the complete interval boundaries
-            bkps_full = [0] + bkps + [total_frames]
-            # logger.debug(f"bkps intervals: {bkps_full}")
-
-            # 2. calculate the average bbox of each interval
-            interval_bboxes = get_interval_average_bbox(bboxes, bkps_full)
-            # logger.debug(f"interval average bboxes: {interval_bboxes}")
-
-            # 3. find the interval index of each missed frame
-            missed_intervals = find_idxs_interval(detect_missed, bkps_full)
-            # logger.debug(
-            #     f"missed frame intervals: {list(zip(detect_missed, missed_intervals))}"
-            # )
-
-            # 4. fill the missed frames with the average bbox of the corresponding interval
-            for missed_idx, interval_idx in zip(detect_missed, missed_intervals):
-                if (
-                    interval_idx < len(interval_bboxes)
-                    and interval_bboxes[interval_idx] is not None
-                ):
-                    frame_and_mask[missed_idx]["bbox"] = interval_bboxes[interval_idx]
-                    logger.debug(f"Filled missed frame {missed_idx} with bbox:\n"
-                    f" {interval_bboxes[interval_idx]}")
-                else:
-                    # if the interval has no valid bbox, use the previous and next frame to complete (fallback strategy)
-                    before = max(missed_idx - 1, 0)
-                    after = min(missed_idx + 1, total_frames - 1)
-                    before_box = frame_and_mask[before]["bbox"]
-                    after_box = frame_and_mask[after]["bbox"]
-                    if before_box:
-                        frame_and_mask[missed_idx]["bbox"] = before_box
-                    elif after_box:
-                        frame_and_mask[missed_idx]["bbox"] = after_box
-        else:
-            del bboxes
-            del bbox_centers
-            del detect_missed
-
-        for idx in tqdm(range(total_frames), desc="Remove watermarks"):
-            frame_info = frame_and_mask[idx]
-            frame = frame_info["frame"]
-            bbox = frame_info["bbox"]
-            if bbox is not None:
-                x1, y1, x2, y2 = bbox
-                mask = np.zeros((height, width), dtype=np.uint8)
-                mask[y1:y2, x1:x2] = 255
-                cleaned_frame = self.cleaner.clean(frame, mask)
-            else:
-                cleaned_frame = frame
-            process_out.stdin.write(cleaned_frame.tobytes())
-
-            # 50% - 95%
-            if progress_callback and idx % 10 == 0:
-                progress = 50 + int((idx / total_frames) * 45)
-                progress_callback(progress)
+        # the previous fill of the temporal mode belongs to another frame range
+        self.cleaner.reset_temporal()
+        frame_writer = ThreadedWriter(_write_frame, PIPELINE_QUEUE_SIZE)
+        try:
+            for frames_batch in batched(enumerate(frame_iter), self.clean_batch_size):
+                idxs = [idx for idx, _ in frames_batch]
+                frames = [frame for _, frame in frames_batch]
+                # frames without a watermark skip the inpainting entirely
+                patches = self.cleaner.clean_patch_batch(
+                    frames,
+                    [bboxes[idx] if idx < num_frames else None for idx in idxs],
+                )
+                for idx, frame, patch in zip(idxs, frames, patches):
+                    # only the inpainted bbox region is written, the rest of the
+                    # decoded frame goes to the encoder untouched
+                    if patch is not None:
+                        paste_patch(frame, *patch)
+                    frame_writer.write(frame)
 
+                    if on_progress and idx % 10 == 0:
+                        on_progress(idx)
+            frame_writer.close()
+        except BaseException:
+            # the output would be incomplete, stop the encoder first, a writer
+            # blocked on its stdin then fails and can be joined, and drop the
+            # partial file
+            process_out.kill()
+            with suppress(OSError):
+                process_out.stdin.close()
+            frame_writer.close(raise_error=False)
+            process_out.wait()
+            Path(output_video_path).unlink(missing_ok=True)
+            raise
         process_out.stdin.close()
         process_out.wait()
+        if process_out.returncode != 0:
+            raise RuntimeError(f"ffmpeg encoder exited with {process_out.returncode}")
+        if self.cleaner.patch_cache is not None:
+            logger.debug(f"patch cache: {self.cleaner.patch_cache.stats()}")
+        if self.cleaner.temporal:
+            logger.debug(f"temporal clean: {self.cleaner.temporal_stats}")
 
-        # 95% - 99%
-        if progress_callback:
-            progress_callback(95)
+    def _plan_copy_segments(
+        self,
+        input_video_loader: VideoLoader,
+        bboxes: list[tuple[int, int, int, int] | None],
+        encode_options: EncodeOptions,
+    ) -> list[tuple[int, int, bool]] | None:
+        """split the video at its IDR keyframes into (start, end, copy) runs
 
-        self.merge_audio_track(input_video_path, temp_output_path, output_video_path)
+        A run is stream copied when none of its GOPs has a watermark. Returns None
+        when nothing can be copied and the whole video goes through the encoder.
+        """
+        num_frames = len(bboxes)
+        no_watermark = np.array([bbox is None for bbox in bboxes], dtype=bool)
+        if num_frames == 0 or not no_watermark.any():
+            return None
+        if no_watermark.all():
+            return [(0, num_frames, True)]
 
-        if progress_callback:
-            progress_callback(99)
+        if self._segment_encode_options(input_video_loader, encode_options) is None:
+            logger.debug(
+                f"GOP copy needs h264 {encode_options.pix_fmt} input the encoder "
+                f"can match, got {input_video_loader.codec_name} "
+                f"{input_video_loader.pix_fmt} {input_video_loader.profile} "
+                f"level {input_video_loader.level}"
+            )
+            return None
 
-    def merge_audio_track(
-        self, input_video_path: Path, temp_output_path: Path, output_video_path: Path
-    ):
-        logger.info("Merging audio track...")
-        video_stream = ffmpeg.input(str(temp_output_path))
-        audio_stream = ffmpeg.input(str(input_video_path)).audio
-
-        (
-            ffmpeg.output(
-                video_stream,
-                audio_stream,
-                str(output_video_path),
-                vcodec="copy",
-                acodec="aac",
+        keyframes = [
+            idx
+            for idx in get_keyframe_indices(
+                input_video_loader.video_path, input_video_loader.fps, idr_only=True
             )
-            .overwrite_output()
-            .run(quiet=True)
+            if idx < num_frames
+        ]
+        gop_copy = np.logical_and.reduceat(no_watermark, keyframes).tolist()
+        segments = []
+        for start, end, copy in zip(keyframes, keyframes[1:] + [num_frames], gop_copy):
+            if segments and segments[-1][2] == copy:
+                segments[-1] = (segments[-1][0], end, copy)
+            else:
+                segments.append((start, end, copy))
+        if not any(copy for _, _, copy in segments):
+            return None
+        return segments
+
+    @staticmethod
+    def _segment_encode_options(
+        input_video_loader: VideoLoader, encode_options: EncodeOptions
+    ) -> EncodeOptions | None:
+        """the options of the segments encoded between stream copied ones
+
+        Copied and encoded GOPs end up in one stream behind the parameter sets of
+        the first segment, so the encoder has to write the codec, pixel format,
+        profile and level of the source. None when the options can not.
+        """
+        profile = X264_PROFILES.get(input_video_loader.profile)
+        source_level = input_video_loader.level
+        if not (
+            input_video_loader.codec_name == "h264"
+            and encode_options.codec == "libx264"
+            and input_video_loader.pix_fmt == encode_options.pix_fmt
+            and profile is not None
+            and source_level is not None
+            and source_level > 0
+        ):
+            return None
+        level = f"{source_level / 10:g}"
+        if encode_options.profile not in (None, profile):
+            return None
+        if encode_options.level not in (None, level):
+            return None
+        return encode_options.model_copy(update={"profile": profile, "level": level})
+
+    def _write_segments(
+        self,
+        input_video_loader: VideoLoader,
+        bboxes: list[tuple[int, int, int, int] | None],
+        segments: list[tuple[int, int, bool]],
+        output_video_path: Path,
+        encode_options: EncodeOptions,
+        on_progress: Callable[[int], None] | None = None,
+    ) -> int:
+        """stream copy the watermark-free segments, clean the others and join them
+
+        Returns the number of stream copied frames.
+        """
+        video_path = input_video_loader.video_path
+        if len(segments) == 1:
+            # no watermark at all, the source is remuxed as is
+            concat_video_segments(
+                [video_path],
+                output_video_path,
+                video_path,
+                input_video_loader.audio_codec,
+            )
+            return segments[0][1]
+
+        copied_frames = 0
+        segment_options = self._segment_encode_options(
+            input_video_loader, encode_options
         )
-        # Clean up temporary file
-        temp_output_path.unlink()
-        logger.info(f"Saved no watermark video with audio at: {output_video_path}")
+        with tempfile.TemporaryDirectory(dir=output_video_path.parent) as tmp_dir:
+            segment_paths = []
+            for segment_idx, (start, end, copy) in enumerate(segments):
+                segment_path = Path(tmp_dir) / f"segment_{segment_idx:05d}.ts"
+                if copy:
+                    copy_video_segment(
+                        video_path, segment_path, start, end, input_video_loader.fps
+                    )
+                    copied_frames += end - start
+                    if on_progress:
+                        on_progress(end)
+                else:
+                    segment_loader = VideoLoader(
+                        video_path,
+                        ring_size=self._frame_ring_size(),
+                        start_frame=start,
+                        end_frame=end,
+                    )
+                    self.clean_video(
+                        segment_loader,
+                        bboxes[start:end],
+                        segment_path,
+                        segment_options,
+                        on_progress=(
+                            (lambda done, start=start: on_progress(start + done))
+                            if on_progress
+                            else None
+                        ),
+                        with_audio=False,
+                        output_format="mpegts",
+                    )
+                segment_paths.append(segment_path)
+            concat_video_segments(
+                segment_paths,
+                output_video_path,
+                video_path,
+                input_video_loader.audio_codec,
+            )
+        return copied_frames
+
+    def _detect_chunks(
+        self,
+        executor: ProcessPoolExecutor,
+        input_video_path: Path,
+        chunks: list[tuple[int, int | None]],
+        total_frames: int,
+        progress_callback: Callable[[int], None] | None = None,
+        cache_key: str | None = None,
+    ) -> tuple[list[tuple[int, int, int, int] | None], list[int]]:
+        """detection pass of `run_parallel`, the imputed bboxes and the chunk lengths"""
+        detect_futures = {
+            executor.submit(_detect_chunk, input_video_path, start, end): chunk_idx
+            for chunk_idx, (start, end) in enumerate(chunks)
+        }
+        chunk_results = [None] * len(chunks)
+        frames_done = 0
+        for future in as_completed(detect_futures):
+            chunk_idx = detect_futures[future]
+            chunk_results[chunk_idx] = future.result()
+            frames_done += len(chunk_results[chunk_idx][0])
+            # 10% - 50%
+            if progress_callback:
+                progress_callback(10 + int(min(frames_done / total_frames, 1) * 40))
+
+        detected_bboxes = [bbox for bboxes, _ in chunk_results for bbox in bboxes]
+        confidences = [
+            c for _, chunk_confidences in chunk_results for c in chunk_confidences
+        ]
+        # imputed over the concatenated chunks, exactly as in `run`
+        bboxes = impute_missed_bboxes(detected_bboxes)
+        if cache_key:
+            self.detection_cache.save(cache_key, detected_bboxes, confidences, bboxes)
+        return bboxes, [len(bboxes) for bboxes, _ in chunk_results]
+
+    def _detection_cache_key(self, input_video_path: Path) -> str | None:
+        if self.detection_cache is None:
+            return None
+        return self.detection_cache.key(
+            input_video_path,
+            WATER_MARK_DETECT_YOLO_WEIGHTS,
+            {
+                "backend": self.detector.backend,
+                "use_roi": self.detector.use_roi,
+                "rois": self.detector.rois,
+                "keyframe_interval": self.detect_keyframe_interval,
+                # the imputed bboxes are cached too
+                "impute_bkps": [
+                    IMPUTE_BKPS_WINDOW,
+                    IMPUTE_BKPS_MIN_SHIFT,
+                    IMPUTE_BKPS_NOISE_Z,
+                    IMPUTE_BKPS_NOISE_HISTORY,
+                ],
+            },
+        )
+
+    def _load_cached_bboxes(
+        self, cache_key: str | None
+    ) -> list[tuple[int, int, int, int] | None] | None:
+        """the imputed bboxes of a cached detection pass, None on a cache miss"""
+        if cache_key is None:
+            return None
+        cached = self.detection_cache.load(cache_key)
+        if cached is None:
+            return None
+        logger.info(
+            f"Loaded detection results of {len(cached.bboxes)} frames from cache"
+        )
+        return cached.imputed_bboxes
+
+    def _worker_kwargs(self) -> dict:
+        """arguments that rebuild this SoraWM in a `run_parallel` worker"""
+        return dict(
+            detect_batch_size=self.detect_batch_size,
+            use_roi_detection=self.detector.use_roi,
+            detect_backend=self.detector.backend,
+            detect_keyframe_interval=self.detect_keyframe_interval,
+            clean_batch_size=self.clean_batch_size,
+            # the parent process reads and writes the cache
+            use_detection_cache=False,
+            patch_cache_size=(
+                self.cleaner.patch_cache.max_size if self.cleaner.patch_cache else 0
+            ),
+            temporal_clean=self.cleaner.temporal,
+            clean_backend=self.cleaner.backend,
+        )
+
+    def _frame_ring_size(self) -> int:
+        """buffers needed by the frames in flight: both pipeline queues and one stage"""
+        held = max(
+            self.detect_batch_size,
+            self.clean_batch_size,
+            (self.detect_keyframe_interval or 0) + 1,
+        )
+        return 2 * PIPELINE_QUEUE_SIZE + held + 2
+
+    def _iter_detections(
+        self, frames: Iterable[np.ndarray]
+    ) -> Iterator[tuple[tuple[int, int, int, int] | None, float | None]]:
+        """yield (bbox, confidence) for every frame, None for both when nothing is found"""
+        if self.detect_keyframe_interval:
+            yield from keyframe_detect(
+                frames,
+                self._detect_one,
+                self.detect_keyframe_interval,
+                DETECT_KEYFRAME_IOU,
+            )
+            return
+
+        for frames_batch in batched(frames, self.detect_batch_size):
+            batch_result = self.detector.detect_batch(
+                list(frames_batch), batch_size=self.detect_batch_size
+            )
+            for detected, bbox, confidence in zip(
+                batch_result["detected"],
+                batch_result["bboxes"],
+                batch_result["confidences"],
+            ):
+                if detected:
+                    yield tuple(int(v) for v in bbox), float(confidence)
+                else:
+                    yield None, None
+
+    def _detect_one(
+        self, frame: np.ndarray
+    ) -> tuple[tuple[int, int, int, int] | None, float | None]:
+        detection_result = self.detector.detect(frame)
+        return detection_result["bbox"], detection_result["confidence"]
+
+
+# the SoraWM of a `run_parallel` worker process, built once by the initializer
+_worker_sora_wm: SoraWM | None = None
+
+
+def _init_parallel_worker(sora_wm_kwargs: dict, num_threads: int):
+    global _worker_sora_wm
+    # every worker gets its share of the cores instead of all of them
+    torch.set_num_threads(num_threads)
+    _worker_sora_wm = SoraWM(**sora_wm_kwargs)
+
+
+def _detect_chunk(
+    video_path: Path, start_frame: int, end_frame: int | None
+) -> tuple[list[tuple[int, int, int, int] | None], list[float | None]]:
+    input_video_loader = VideoLoader(
+        video_path,
+        ring_size=_worker_sora_wm._frame_ring_size(),
+        start_frame=start_frame,
+        end_frame=end_frame,
+    )
+    return _worker_sora_wm.detect_watermarks(input_video_loader)
+
+
+def _clean_chunk(
+    video_path: Path,
+    start_frame: int,
+    end_frame: int | None,
+    bboxes: list[tuple[int, int, int, int] | None],
+    segment_path: Path,
+    encode_options: EncodeOptions,
+):
+    input_video_loader = VideoLoader(
+        video_path,
+        ring_size=_worker_sora_wm._frame_ring_size(),
+        start_frame=start_frame,
+        end_frame=end_frame,
+    )
+    _worker_sora_wm.clean_video(
+        input_video_loader,
+        bboxes,
+        segment_path,
+        encode_options,
+        with_audio=False,
+        output_format="mpegts",
+    )
 
 
 if __name__ == "__main__":
@@ -94,6 +94,11 @@ def get_args_parser():
     parser.add_argument("--device", default="cuda", type=str)
     parser.add_argument("--times", default=10, type=int)
     parser.add_argument("--empty-cache", action="store_true")
+    parser.add_argument(
+        "--erase-backend", default="torch", choices=["torch", "torchscript", "onnx"]
+    )
+    parser.add_argument("--intra-op-threads", default=0, type=int)
+    parser.add_argument("--inter-op-threads", default=0, type=int)
     return parser.parse_args()
 
 
@@ -105,5 +110,8 @@ if __name__ == "__main__":
         device=device,
         disable_nsfw=True,
         sd_cpu_textencoder=True,
+        erase_backend=args.erase_backend,
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
     )
     benchmark(model, args.times, args.empty_cache)
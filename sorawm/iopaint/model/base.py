@@ -14,6 +14,7 @@ from sorawm.iopaint.helper import (
 )
 from sorawm.iopaint.schema import HDStrategy, InpaintRequest, SDSampler
 
+from .erase_backend import ERASE_BACKENDS
 from .helper.g_diffuser_bot import expand_image
 from .utils import get_scheduler
 
@@ -24,6 +25,8 @@ class InpaintModel:
     pad_mod = 8
     pad_to_square = False
     is_erase_model = False
+    # backends of `load_erase_model` the model can run on
+    erase_backends = ERASE_BACKENDS
 
     def __init__(self, device, **kwargs):
         """
@@ -53,6 +56,14 @@ class InpaintModel:
         """
         ...
 
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        """Batched forward, all images and masks have the same size
+        images: list of [H, W, C] RGB
+        masks: list of [H, W, 1] 255 为 masks 区域
+        return: list of BGR IMAGE
+        """
+        return [self.forward(image, mask, config) for image, mask in zip(images, masks)]
+
     @staticmethod
     def download():
         ...
@@ -80,6 +91,42 @@ class InpaintModel:
             result = result * (mask / 255) + image[:, :, ::-1] * (1 - (mask / 255))
         return result
 
+    def _pad_forward_batch(self, images, masks, config: InpaintRequest):
+        """`_pad_forward` of images that pad to the same size, in one forward"""
+        pad_images = [
+            pad_img_to_modulo(
+                image,
+                mod=self.pad_mod,
+                square=self.pad_to_square,
+                min_size=self.min_size,
+            )
+            for image in images
+        ]
+        pad_masks = [
+            pad_img_to_modulo(
+                mask,
+                mod=self.pad_mod,
+                square=self.pad_to_square,
+                min_size=self.min_size,
+            )
+            for mask in masks
+        ]
+
+        results = self.forward_batch(pad_images, pad_masks, config)
+
+        outputs = []
+        for result, image, mask in zip(results, images, masks):
+            origin_height, origin_width = image.shape[:2]
+            image, mask = self.forward_pre_process(image, mask, config)
+            result = result[0:origin_height, 0:origin_width, :]
+            result, image, mask = self.forward_post_process(result, image, mask, config)
+
+            if config.sd_keep_unmasked_area:
+                mask = mask[:, :, np.newaxis]
+                result = result * (mask / 255) + image[:, :, ::-1] * (1 - (mask / 255))
+            outputs.append(result)
+        return outputs
+
     def forward_pre_process(self, image, mask, config):
         return image, mask
 
@@ -142,6 +189,32 @@ class InpaintModel:
 
         return inpaint_result
 
+    def _hd_strategy_triggered(self, image, config: InpaintRequest) -> bool:
+        if config.hd_strategy == HDStrategy.CROP:
+            return max(image.shape) > config.hd_strategy_crop_trigger_size
+        if config.hd_strategy == HDStrategy.RESIZE:
+            return max(image.shape) > config.hd_strategy_resize_limit
+        return False
+
+    @torch.no_grad()
+    def call_batch(self, images, masks, config: InpaintRequest):
+        """
+        images: list of [H, W, C] RGB with the same size, not normalized
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+
+        Images small enough to skip the hd strategy go through one batched
+        forward, everything else falls back to per image __call__.
+        """
+        if (
+            not self.is_erase_model
+            or len(images) == 1
+            or self._hd_strategy_triggered(images[0], config)
+        ):
+            return [self(image, mask, config) for image, mask in zip(images, masks)]
+
+        return self._pad_forward_batch(images, masks, config)
+
     def _crop_box(self, image, mask, box, config: InpaintRequest):
         """
 
@@ -0,0 +1,167 @@
+import os
+from pathlib import Path
+from typing import Callable, Dict, Sequence
+
+import torch
+from loguru import logger
+
+from sorawm.iopaint.helper import get_cache_path_by_url, load_jit_model
+
+# "torch" runs the traced model as is, "torchscript" freezes it and applies the
+# torchscript inference passes, "onnx" exports it once and runs onnxruntime
+ERASE_BACKENDS = ["torch", "torchscript", "onnx"]
+
+
+def erase_backend_options(kwargs: Dict) -> Dict:
+    """the `load_erase_model` options among the kwargs of `ModelManager`"""
+    return dict(
+        backend=kwargs.get("erase_backend", "torch"),
+        intra_op_threads=kwargs.get("intra_op_threads", 0),
+        inter_op_threads=kwargs.get("inter_op_threads", 0),
+    )
+
+
+class OnnxEraseModel:
+    """onnxruntime session called like the traced torch module it was exported from"""
+
+    def __init__(
+        self, onnx_path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0
+    ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 follows torch, which already holds the share of the cores of this process
+        options.intra_op_num_threads = intra_op_threads or torch.get_num_threads()
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(
+            str(onnx_path), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [it.name for it in self.session.get_inputs()]
+
+    def __call__(self, *inputs: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(
+            None,
+            {
+                name: tensor.detach().cpu().numpy()
+                for name, tensor in zip(self.input_names, inputs)
+            },
+        )
+        return torch.from_numpy(outputs[0])
+
+    def eval(self):
+        return self
+
+
+def export_onnx(
+    model: torch.nn.Module,
+    sample_inputs: Sequence[torch.Tensor],
+    model_path: Path,
+    onnx_path: Path,
+) -> Path:
+    """export a traced model with dynamic batch and spatial axes, again only when
+    the model file at `model_path` is newer than the export"""
+    if (
+        onnx_path.exists()
+        and onnx_path.stat().st_mtime >= Path(model_path).stat().st_mtime
+    ):
+        return onnx_path
+    logger.info(f"Exporting {onnx_path.name}, once.")
+    input_names = [f"input_{i}" for i in range(len(sample_inputs))]
+    dynamic_axes = {
+        name: {0: "batch", 2: "height", 3: "width"} for name in input_names + ["output"]
+    }
+    tmp_path = onnx_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        torch.onnx.export(
+            model,
+            tuple(sample_inputs),
+            str(tmp_path),
+            input_names=input_names,
+            output_names=["output"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            # the torchscript exporter, the models are loaded as ScriptModules
+            dynamo=False,
+        )
+        os.replace(tmp_path, onnx_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    logger.success(f"✓ Onnx model exported: {onnx_path}")
+    return onnx_path
+
+
+def set_torch_threads(intra_op_threads: int, inter_op_threads: int):
+    """set the torch thread pools, 0 keeps a pool as is
+
+    The pools are process wide, the counts also apply to every other model and
+    torch op of the process.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # only possible before the first inter op parallel work of the process
+            logger.warning(f"Can not set the inter op threads: {e}")
+
+
+def load_erase_model(
+    url_or_path: str,
+    device,
+    model_md5: str,
+    sample_inputs: Callable[[], Sequence[torch.Tensor]],
+    backend: str = "torch",
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+):
+    """`load_jit_model` on the chosen inference backend, warmed up with one forward
+
+    `sample_inputs` builds the inputs of the warm up and of the onnx export.
+    Backends other than "torch" only apply on the cpu. A model the onnx exporter
+    can not handle raises instead of running on another backend than asked for.
+    Thread counts other than 0 are set on the process wide torch pools, see
+    `set_torch_threads`.
+    """
+    if backend not in ERASE_BACKENDS:
+        raise ValueError(f"Unknown erase backend: {backend}, one of {ERASE_BACKENDS}")
+    model = load_jit_model(url_or_path, device, model_md5)
+    on_cpu = torch.device(device).type == "cpu"
+    if on_cpu and (intra_op_threads or inter_op_threads):
+        set_torch_threads(intra_op_threads, inter_op_threads)
+
+    if backend == "onnx" and on_cpu:
+        model_path = (
+            url_or_path
+            if os.path.exists(url_or_path)
+            else get_cache_path_by_url(url_or_path)
+        )
+        try:
+            with torch.no_grad():
+                onnx_path = export_onnx(
+                    model,
+                    sample_inputs(),
+                    Path(model_path),
+                    Path(model_path).with_suffix(".onnx"),
+                )
+        except Exception as e:
+            raise RuntimeError(
+                f"Can not export {Path(model_path).name} to onnx, use the "
+                f"torchscript or torch erase backend: {e}"
+            ) from e
+        model = OnnxEraseModel(onnx_path, intra_op_threads, inter_op_threads)
+    if backend == "torchscript" and on_cpu:
+        try:
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(model.eval()))
+        except Exception as e:
+            logger.warning(f"Torchscript optimization failed, using torch: {e}")
+            backend = "torch"
+
+    # the first forwards pay for allocations and the graph optimizations, keep
+    # them out of the first frame
+    with torch.no_grad():
+        model(*[it.to(device) for it in sample_inputs()])
+    logger.info(f"Erase model ready on the {backend} backend.")
+    return model
@@ -7,12 +7,12 @@ import torch
 from sorawm.iopaint.helper import (
     download_model,
     get_cache_path_by_url,
-    load_jit_model,
     norm_img,
 )
 from sorawm.iopaint.schema import InpaintRequest
 
 from .base import InpaintModel
+from .erase_backend import erase_backend_options, load_erase_model
 
 LAMA_MODEL_URL = os.environ.get(
     "LAMA_MODEL_URL",
@@ -33,13 +33,25 @@ class LaMa(InpaintModel):
     name = "lama"
     pad_mod = 8
     is_erase_model = True
+    # the fourier convolutions have no onnx export
+    erase_backends = ["torch", "torchscript"]
 
     @staticmethod
     def download():
         download_model(LAMA_MODEL_URL, LAMA_MODEL_MD5)
 
     def init_model(self, device, **kwargs):
-        self.model = load_jit_model(LAMA_MODEL_URL, device, LAMA_MODEL_MD5).eval()
+        self.model = load_erase_model(
+            LAMA_MODEL_URL,
+            device,
+            LAMA_MODEL_MD5,
+            self.sample_inputs,
+            **erase_backend_options(kwargs),
+        ).eval()
+
+    @staticmethod
+    def sample_inputs():
+        return torch.rand(1, 3, 256, 256), torch.zeros(1, 1, 256, 256)
 
     @staticmethod
     def is_downloaded() -> bool:
@@ -65,6 +77,24 @@ class LaMa(InpaintModel):
         cur_res = cv2.cvtColor(cur_res, cv2.COLOR_RGB2BGR)
         return cur_res
 
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        """Input images and output images have same size
+        images: list of [H, W, C] RGB, all with the same size
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+        """
+        images = np.stack([norm_img(image) for image in images])
+        masks = np.stack([(norm_img(mask) > 0) * 1 for mask in masks])
+
+        images = torch.from_numpy(images).to(self.device)
+        masks = torch.from_numpy(masks).to(self.device)
+
+        inpainted_images = self.model(images, masks)
+
+        cur_res = inpainted_images.permute(0, 2, 3, 1).detach().cpu().numpy()
+        cur_res = np.clip(cur_res * 255, 0, 255).astype("uint8")
+        return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in cur_res]
+
 
 class AnimeLaMa(LaMa):
     name = "anime-lama"
@@ -74,8 +104,12 @@ class AnimeLaMa(LaMa):
         download_model(ANIME_LAMA_MODEL_URL, ANIME_LAMA_MODEL_MD5)
 
     def init_model(self, device, **kwargs):
-        self.model = load_jit_model(
-            ANIME_LAMA_MODEL_URL, device, ANIME_LAMA_MODEL_MD5
+        self.model = load_erase_model(
+            ANIME_LAMA_MODEL_URL,
+            device,
+            ANIME_LAMA_MODEL_MD5,
+            self.sample_inputs,
+            **erase_backend_options(kwargs),
         ).eval()
 
     @staticmethod
@@ -7,10 +7,11 @@ import numpy as np
 import torch
 from loguru import logger
 
-from sorawm.iopaint.helper import download_model, get_cache_path_by_url, load_jit_model
+from sorawm.iopaint.helper import download_model, get_cache_path_by_url
 from sorawm.iopaint.schema import InpaintRequest
 
 from .base import InpaintModel
+from .erase_backend import erase_backend_options, load_erase_model
 
 MANGA_INPAINTOR_MODEL_URL = os.environ.get(
     "MANGA_INPAINTOR_MODEL_URL",
@@ -35,11 +36,21 @@ class Manga(InpaintModel):
     is_erase_model = True
 
     def init_model(self, device, **kwargs):
-        self.inpaintor_model = load_jit_model(
-            MANGA_INPAINTOR_MODEL_URL, device, MANGA_INPAINTOR_MODEL_MD5
+        backend_options = erase_backend_options(kwargs)
+        # gray image, lines, mask, noise and ones, all single channel
+        self.inpaintor_model = load_erase_model(
+            MANGA_INPAINTOR_MODEL_URL,
+            device,
+            MANGA_INPAINTOR_MODEL_MD5,
+            lambda: [torch.rand(1, 1, 256, 256) for _ in range(5)],
+            **backend_options,
         )
-        self.line_model = load_jit_model(
-            MANGA_LINE_MODEL_URL, device, MANGA_LINE_MODEL_MD5
+        self.line_model = load_erase_model(
+            MANGA_LINE_MODEL_URL,
+            device,
+            MANGA_LINE_MODEL_MD5,
+            lambda: (torch.rand(1, 1, 256, 256) * 255,),
+            **backend_options,
         )
         self.seed = 42
 
@@ -1,19 +1,20 @@
 import os
 
 import cv2
+import numpy as np
 import torch
 
 from sorawm.iopaint.helper import (
     boxes_from_mask,
     download_model,
     get_cache_path_by_url,
-    load_jit_model,
     norm_img,
     resize_max_size,
 )
 from sorawm.iopaint.schema import InpaintRequest
 
 from .base import InpaintModel
+from .erase_backend import erase_backend_options, load_erase_model
 
 MIGAN_MODEL_URL = os.environ.get(
     "MIGAN_MODEL_URL",
@@ -30,7 +31,13 @@ class MIGAN(InpaintModel):
     is_erase_model = True
 
     def init_model(self, device, **kwargs):
-        self.model = load_jit_model(MIGAN_MODEL_URL, device, MIGAN_MODEL_MD5).eval()
+        self.model = load_erase_model(
+            MIGAN_MODEL_URL,
+            device,
+            MIGAN_MODEL_MD5,
+            lambda: (torch.rand(1, 4, 512, 512),),
+            **erase_backend_options(kwargs),
+        ).eval()
 
     @staticmethod
     def download():
@@ -50,16 +57,70 @@ class MIGAN(InpaintModel):
         if image.shape[0] == 512 and image.shape[1] == 512:
             return self._pad_forward(image, mask, config)
 
-        boxes = boxes_from_mask(mask)
-        crop_result = []
+        crops = self._box_crops(image, mask, config)
+        inpaint_results = [
+            self._pad_forward(resize_image, resize_mask, config)
+            for _, _, _, resize_image, resize_mask in crops
+        ]
+        return self._paste_crops(image, crops, inpaint_results)
+
+    @torch.no_grad()
+    def call_batch(self, images, masks, config: InpaintRequest):
+        """
+        images: list of [H, W, C] RGB with the same size, not normalized
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+
+        The same box crops as __call__, all of them in one forward, so the
+        result does not depend on the batch size.
+        """
+        if len(images) == 1:
+            return [self(images[0], masks[0], config)]
+        if images[0].shape[0] == 512 and images[0].shape[1] == 512:
+            return self._pad_forward_batch(images, masks, config)
+
+        crops_per_image = [
+            self._box_crops(image, mask, config) for image, mask in zip(images, masks)
+        ]
+        # every resized crop pads to the same 512 square
+        resized = [crop[3:] for crops in crops_per_image for crop in crops]
+        inpaint_results = (
+            self._pad_forward_batch(
+                [it[0] for it in resized], [it[1] for it in resized], config
+            )
+            if resized
+            else []
+        )
+
+        outputs = []
+        start = 0
+        for image, crops in zip(images, crops_per_image):
+            outputs.append(
+                self._paste_crops(
+                    image, crops, inpaint_results[start : start + len(crops)]
+                )
+            )
+            start += len(crops)
+        return outputs
+
+    def _box_crops(self, image, mask, config: InpaintRequest):
+        """a crop with margin around each box of the mask, and its resize to 512"""
         config.hd_strategy_crop_margin = 128
-        for box in boxes:
+        crops = []
+        for box in boxes_from_mask(mask):
             crop_image, crop_mask, crop_box = self._crop_box(image, mask, box, config)
-            origin_size = crop_image.shape[:2]
             resize_image = resize_max_size(crop_image, size_limit=512)
             resize_mask = resize_max_size(crop_mask, size_limit=512)
-            inpaint_result = self._pad_forward(resize_image, resize_mask, config)
+            crops.append((crop_image, crop_mask, crop_box, resize_image, resize_mask))
+        return crops
 
+    @staticmethod
+    def _paste_crops(image, crops, inpaint_results):
+        crop_result = []
+        for (crop_image, crop_mask, crop_box, _, _), inpaint_result in zip(
+            crops, inpaint_results
+        ):
+            origin_size = crop_image.shape[:2]
             # only paste masked area result
             inpaint_result = cv2.resize(
                 inpaint_result,
@@ -109,3 +170,28 @@ class MIGAN(InpaintModel):
         output = output[0].cpu().numpy()
         cur_res = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
         return cur_res
+
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        """Input images and output images have same size
+        images: list of [H, W, C] RGB, all with the same size
+        masks: list of [H, W] mask area == 255
+        return: list of BGR IMAGE
+        """
+        images = np.stack([norm_img(image) * 2 - 1 for image in images])
+        masks = np.stack([norm_img((mask > 120) * 255) for mask in masks])
+
+        images = torch.from_numpy(images).to(self.device)
+        masks = torch.from_numpy(masks).to(self.device)
+
+        erased_imgs = images * (1 - masks)
+        input_images = torch.cat([0.5 - masks, erased_imgs], dim=1)
+
+        output = self.model(input_images)
+        output = (
+            (output.permute(0, 2, 3, 1) * 127.5 + 127.5)
+            .round()
+            .clamp(0, 255)
+            .to(torch.uint8)
+        )
+        output = output.cpu().numpy()
+        return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in output]
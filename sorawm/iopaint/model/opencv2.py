@@ -29,3 +29,11 @@ class OpenCV2(InpaintModel):
             flags=flag_map[config.cv2_flag],
         )
         return cur_res
+
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        """cv2.inpaint has no batched variant, images are inpainted one by one
+        images: list of [H, W, C] RGB
+        masks: list of [H, W, 1]
+        return: list of BGR IMAGE
+        """
+        return [self.forward(image, mask, config) for image, mask in zip(images, masks)]
@@ -110,6 +110,22 @@ class ModelManager:
         self.enable_disable_lcm_lora(config)
         return self.model(image, mask, config).astype(np.uint8)
 
+    @torch.inference_mode()
+    def forward_batch(self, images, masks, config: InpaintRequest):
+        """
+
+        Args:
+            images: list of [H, W, C] RGB, all with the same size
+            masks: list of [H, W, 1] 255 means area to repaint
+            config:
+
+        Returns:
+            list of BGR image
+        """
+        return [
+            it.astype(np.uint8) for it in self.model.call_batch(images, masks, config)
+        ]
+
     def scan_models(self) -> List[ModelInfo]:
         available_models = scan_models()
         self.available_models = {it.name: it for it in available_models}
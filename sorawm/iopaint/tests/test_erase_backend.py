@@ -0,0 +1,83 @@
+import os
+
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+
+from sorawm.iopaint.model import erase_backend
+from sorawm.iopaint.model.erase_backend import OnnxEraseModel, load_erase_model
+
+
+class TinyEraseModel(torch.nn.Module):
+    """an image and mask to image model, traced and loaded like the erase models"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+
+    def forward(self, image, mask):
+        x = torch.cat([image * (1 - mask), mask], dim=1)
+        return torch.sigmoid(self.conv(x))
+
+
+def sample_inputs():
+    return [torch.rand(1, 3, 64, 64), torch.rand(1, 1, 64, 64)]
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    model_path = tmp_path / "tiny.pt"
+    traced = torch.jit.trace(TinyEraseModel().eval(), tuple(sample_inputs()))
+    torch.jit.save(traced, str(model_path))
+    return model_path
+
+
+@pytest.mark.parametrize("backend", ["torch", "torchscript", "onnx"])
+def test_backends_match_torch(model_path, backend):
+    reference = torch.jit.load(str(model_path))
+    model = load_erase_model(str(model_path), "cpu", "", sample_inputs, backend)
+    if backend == "onnx":
+        assert isinstance(model, OnnxEraseModel)
+        assert model_path.with_suffix(".onnx").exists()
+    # the onnx axes are dynamic, another batch and size than the export
+    inputs = [torch.rand(2, 3, 80, 96), torch.rand(2, 1, 80, 96)]
+    with torch.no_grad():
+        torch.testing.assert_close(model(*inputs), reference(*inputs))
+
+
+def test_failed_onnx_export_raises(model_path, monkeypatch):
+    def _export_onnx(*args):
+        raise RuntimeError("unsupported operator")
+
+    monkeypatch.setattr(erase_backend, "export_onnx", _export_onnx)
+    with pytest.raises(RuntimeError, match="unsupported operator"):
+        load_erase_model(str(model_path), "cpu", "", sample_inputs, "onnx")
+
+
+def test_default_threads_are_kept(model_path):
+    num_threads = torch.get_num_threads()
+    load_erase_model(str(model_path), "cpu", "", sample_inputs, "torch")
+    assert torch.get_num_threads() == num_threads
+
+
+def test_onnx_export_follows_the_model(model_path):
+    load_erase_model(str(model_path), "cpu", "", sample_inputs, "onnx")
+    onnx_path = model_path.with_suffix(".onnx")
+    exported = onnx_path.stat().st_mtime_ns
+    # kept while the model is older
+    load_erase_model(str(model_path), "cpu", "", sample_inputs, "onnx")
+    assert onnx_path.stat().st_mtime_ns == exported
+
+    # and exported again once the model changes
+    os.utime(model_path, ns=(exported + 10**9, exported + 10**9))
+    load_erase_model(str(model_path), "cpu", "", sample_inputs, "onnx")
+    assert onnx_path.stat().st_mtime_ns > exported
+    assert list(model_path.parent.glob("*.tmp")) == []
+
+
+def test_lama_refuses_onnx():
+    from sorawm.watermark_cleaner import WaterMarkCleaner
+
+    with pytest.raises(ValueError, match="can not run on the onnx clean backend"):
+        WaterMarkCleaner(backend="onnx")
@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 import torch
 
@@ -8,6 +9,7 @@ from sorawm.iopaint.tests.utils import (
     check_device,
     current_dir,
     get_config,
+    get_data,
 )
 
 
@@ -163,3 +165,21 @@ def test_mi_gan(device, strategy):
         fx=1.5,
         fy=1.7,
     )
+
+
+@pytest.mark.parametrize("name", ["lama", "cv2"])
+def test_forward_batch(name):
+    model = ModelManager(name=name, device=torch.device("cpu"))
+    cfg = get_config(strategy=HDStrategy.ORIGINAL)
+    img, mask = get_data(
+        img_p=current_dir / "overture-creations-5sI6fQgYIuo.png",
+        mask_p=current_dir / "overture-creations-5sI6fQgYIuo_mask.png",
+    )
+
+    expected = model(img, mask, cfg)
+    results = model.forward_batch([img, img], [mask, mask], cfg)
+
+    assert len(results) == 2
+    for res in results:
+        assert res.shape == expected.shape
+        assert np.abs(res.astype(np.int32) - expected.astype(np.int32)).max() <= 1
@@ -0,0 +1,96 @@
+from enum import StrEnum
+
+from pydantic import BaseModel, Field
+
+
+class EncodeProfile(StrEnum):
+    # libx264 slow, 1.2x the source bitrate, best quality per byte
+    DEFAULT = "default"
+    # libx264 veryfast at crf 20, a bit larger files for several times the speed
+    FAST = "fast"
+
+
+class EncodeOptions(BaseModel):
+    codec: str = Field("libx264", description="ffmpeg video encoder")
+    preset: str | None = Field("slow", description="Encoder speed/size preset")
+    crf: int | None = Field(
+        18, description="Constant rate factor, used when no bitrate applies"
+    )
+    bitrate: str | None = Field(
+        None, description="Target video bitrate, e.g. '4M', takes priority over crf"
+    )
+    bitrate_factor: float | None = Field(
+        1.2,
+        description="Target bitrate as a multiple of the source bitrate, when it is known",
+    )
+    threads: int | None = Field(None, description="Encoder threads, None for auto")
+    tune: str | None = Field(None, description="Encoder tune, e.g. 'film'")
+    x264_params: str | None = Field(
+        None, description="Extra libx264 options, e.g. 'rc-lookahead=10'"
+    )
+    pix_fmt: str = Field("yuv420p")
+    profile: str | None = Field(None, description="Encoder profile, e.g. 'high'")
+    level: str | None = Field(None, description="Encoder level, e.g. '4.1'")
+
+    @classmethod
+    def from_profile(cls, profile: EncodeProfile, **overrides) -> "EncodeOptions":
+        """the options of a profile, the `overrides` that are not None on top"""
+        options = dict(ENCODE_PROFILES[EncodeProfile(profile)])
+        overrides = {
+            key: value for key, value in overrides.items() if value is not None
+        }
+        # an explicit crf asks for constant quality, not the bitrate target
+        if "crf" in overrides and "bitrate_factor" not in overrides:
+            options["bitrate_factor"] = None
+        return cls(**{**options, **overrides})
+
+    def to_ffmpeg_kwargs(self, original_bitrate: str | None = None) -> dict:
+        """output options for ffmpeg-python, `original_bitrate` is the source bitrate in bps"""
+        output_options = {"pix_fmt": self.pix_fmt, "vcodec": self.codec}
+        if self.preset:
+            output_options["preset"] = self.preset
+        if self.bitrate:
+            output_options["video_bitrate"] = self.bitrate
+        elif self.bitrate_factor and original_bitrate:
+            output_options["video_bitrate"] = str(
+                int(int(original_bitrate) * self.bitrate_factor)
+            )
+        elif self.crf is not None:
+            output_options["crf"] = str(self.crf)
+        if self.threads:
+            output_options["threads"] = str(self.threads)
+        if self.tune:
+            output_options["tune"] = self.tune
+        if self.x264_params:
+            output_options["x264-params"] = self.x264_params
+        if self.profile:
+            output_options["profile:v"] = self.profile
+        if self.level:
+            output_options["level"] = self.level
+        return output_options
+
+
+ENCODE_PROFILES = {
+    EncodeProfile.DEFAULT: {},
+    EncodeProfile.FAST: {"preset": "veryfast", "crf": 20, "bitrate_factor": None},
+}
+
+
+class CleanReport(BaseModel):
+    total_frames: int = Field(0, description="Frames in the video")
+    watermark_frames: int = Field(0, description="Frames that were inpainted")
+    no_watermark_frames: int = Field(
+        0, description="Frames without a watermark, written untouched"
+    )
+    copied_frames: int = Field(
+        0, description="Frames stream copied from the source without re-encoding"
+    )
+
+    @classmethod
+    def from_bboxes(cls, bboxes: list) -> "CleanReport":
+        watermark_frames = sum(bbox is not None for bbox in bboxes)
+        return cls(
+            total_frames=len(bboxes),
+            watermark_frames=watermark_frames,
+            no_watermark_frames=len(bboxes) - watermark_frames,
+        )
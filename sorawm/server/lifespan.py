@@ -24,4 +24,5 @@ async def lifespan(app: FastAPI):
     yield
 
     logger.info("Shutting down...")
+    await worker.shutdown()
     logger.info("Application shutdown complete")
@@ -0,0 +1,59 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sorawm.server.schemas import Status, WMRemoveResults
+
+TERMINAL_STATUSES = (Status.FINISHED, Status.ERROR)
+
+
+class ProgressBroker:
+    """In memory pub/sub of the task states.
+
+    Holds the latest state of every task still in flight and pushes each new one
+    to the subscribers of that task. Subscribers only care about the newest
+    state, so a slow one skips the states it did not consume in time instead of
+    queueing them. A task is forgotten once it reaches a terminal state, the
+    database holds it from then on.
+    """
+
+    def __init__(self):
+        self._latest: dict[str, WMRemoveResults] = {}
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    def latest(self, task_id: str) -> WMRemoveResults | None:
+        return self._latest.get(task_id)
+
+    def publish(self, task_id: str, result: WMRemoveResults):
+        if result.status in TERMINAL_STATUSES:
+            self._latest.pop(task_id, None)
+        else:
+            self._latest[task_id] = result
+        for queue in self._subscribers.get(task_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(result)
+
+    def publish_progress(self, task_id: str, percentage: int) -> bool:
+        """a new percentage of a processing task, False when it is not one anymore"""
+        latest = self._latest.get(task_id)
+        # progress of a worker process can arrive after the task ended
+        if latest is None or latest.status != Status.PROCESSING:
+            return False
+        self.publish(
+            task_id, WMRemoveResults(percentage=percentage, status=Status.PROCESSING)
+        )
+        return True
+
+    @asynccontextmanager
+    async def subscribe(self, task_id: str) -> AsyncIterator[asyncio.Queue]:
+        """a queue receiving the new states of the task while the context is open"""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers[task_id].add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[task_id].discard(queue)
+            if not self._subscribers[task_id]:
+                del self._subscribers[task_id]
@@ -1,38 +1,175 @@
+import asyncio
+import hashlib
 from pathlib import Path
 from uuid import uuid4
 
 import aiofiles
-from fastapi import APIRouter, BackgroundTasks, File, HTTPException, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    UploadFile,
+)
+from fastapi.responses import FileResponse, StreamingResponse
+from loguru import logger
 
-from sorawm.server.schemas import WMRemoveResults
+from sorawm.configs import SSE_KEEPALIVE_SECONDS, UPLOAD_CHUNK_SIZE
+from sorawm.schemas import EncodeOptions, EncodeProfile
+from sorawm.server.schemas import (
+    ChunkedUploadCreate,
+    ChunkedUploadStatus,
+    WMRemoveResults,
+    WorkerPoolStats,
+)
+from sorawm.server.progress import TERMINAL_STATUSES
+from sorawm.server.uploads import ChunkedUploadStore, UploadBusyError
 from sorawm.server.worker import worker
+from sorawm.utils.video_utils import sniff_video_container
 
 router = APIRouter()
+upload_store = ChunkedUploadStore(worker.upload_dir)
 
 
-async def process_upload_and_queue(
-    task_id: str, video_content: bytes, video_path: Path
+async def save_upload(video: UploadFile, video_path: Path) -> str:
+    """stream the upload to disk chunk by chunk, returns its sha256
+
+    The container is checked on the first chunk, a ValueError is raised before
+    the rest is written when it is not a video.
+    """
+    sha256 = hashlib.sha256()
+    first_chunk = True
+    async with aiofiles.open(video_path, "wb") as f:
+        while chunk := await video.read(UPLOAD_CHUNK_SIZE):
+            if first_chunk and sniff_video_container(chunk) is None:
+                raise ValueError(f"{video.filename} is not a supported video")
+            first_chunk = False
+            sha256.update(chunk)
+            await f.write(chunk)
+    if first_chunk:
+        raise ValueError(f"{video.filename} is empty")
+    return sha256.hexdigest()
+
+
+def encode_options_form(
+    encode_profile: EncodeProfile = Form(EncodeProfile.DEFAULT),
+    preset: str | None = Form(None),
+    crf: int | None = Form(None),
+    bitrate: str | None = Form(None),
+    bitrate_factor: float | None = Form(None),
+    threads: int | None = Form(None),
+    tune: str | None = Form(None),
+    x264_params: str | None = Form(None),
+) -> EncodeOptions:
+    """the encode profile of the form, with the `EncodeOptions` fields it sets"""
+    return EncodeOptions.from_profile(
+        encode_profile,
+        preset=preset,
+        crf=crf,
+        bitrate=bitrate,
+        bitrate_factor=bitrate_factor,
+        threads=threads,
+        tune=tune,
+        x264_params=x264_params,
+    )
+
+
+@router.post("/submit_remove_task")
+async def submit_remove_task(
+    video: UploadFile = File(...),
+    encode_options: EncodeOptions = Depends(encode_options_form),
 ):
+    task_id = await worker.create_task()
+    upload_filename = f"{uuid4()}_{Path(video.filename or 'video.mp4').name}"
+    video_path = worker.upload_dir / upload_filename
     try:
-        async with aiofiles.open(video_path, "wb") as f:
-            await f.write(video_content)
-        await worker.queue_task(task_id, video_path)
+        sha256 = await save_upload(video, video_path)
     except Exception as e:
+        video_path.unlink(missing_ok=True)
         await worker.mark_task_error(task_id, str(e))
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    logger.info(f"Task {task_id} uploaded {video_path.name}, sha256 {sha256}")
+    # queued as soon as the last chunk is on disk
+    await worker.queue_task(task_id, video_path, encode_options)
 
+    return {"task_id": task_id, "sha256": sha256, "message": "Task submitted."}
 
-@router.post("/submit_remove_task")
-async def submit_remove_task(
-    background_tasks: BackgroundTasks, video: UploadFile = File(...)
+
+@router.post("/uploads")
+async def create_upload(upload: ChunkedUploadCreate) -> ChunkedUploadStatus:
+    if upload.size > upload_store.max_size:
+        raise HTTPException(status_code=413, detail="Upload is too large.")
+    try:
+        return await upload_store.create(upload.filename, upload.size, upload.sha256)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str) -> ChunkedUploadStatus:
+    try:
+        return await upload_store.status(upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload does not exist.")
+
+
+@router.put("/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    offset: int = Query(...),
+    x_chunk_sha256: str | None = Header(None),
+) -> ChunkedUploadStatus:
+    # the size is checked before anything is read, and the body is read up to it
+    length_header = request.headers.get("content-length", "")
+    if not length_header.isdigit():
+        raise HTTPException(status_code=411, detail="Content-Length is required.")
+    content_length = int(length_header)
+    if content_length > upload_store.chunk_size:
+        raise HTTPException(status_code=413, detail="Chunk is too large.")
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > content_length:
+            raise HTTPException(status_code=400, detail="Chunk exceeds its length.")
+    try:
+        return await upload_store.write_chunk(
+            upload_id, index, offset, bytes(data), x_chunk_sha256
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload does not exist.")
+    except UploadBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(
+    upload_id: str,
+    encode_options: EncodeOptions = Depends(encode_options_form),
 ):
+    try:
+        filename = await upload_store.filename(upload_id)
+        video_path = worker.upload_dir / f"{uuid4()}_{filename}"
+        sha256 = await upload_store.finalize(upload_id, video_path)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload does not exist.")
+    except UploadBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     task_id = await worker.create_task()
-    content = await video.read()
-    upload_filename = f"{uuid4()}_{video.filename}"
-    video_path = worker.upload_dir / upload_filename
-    background_tasks.add_task(process_upload_and_queue, task_id, content, video_path)
+    await worker.queue_task(task_id, video_path, encode_options)
 
-    return {"task_id": task_id, "message": "Task submitted."}
+    return {"task_id": task_id, "sha256": sha256, "message": "Task submitted."}
 
 
 @router.get("/get_results")
@@ -44,6 +181,39 @@ async def get_results(remove_task_id: str) -> WMRemoveResults:
     return result
 
 
+@router.get("/tasks/{task_id}/events")
+async def task_events(task_id: str, request: Request):
+    """server sent events of the task state, until it finishes or fails"""
+    if await worker.get_task_status(task_id) is None:
+        raise HTTPException(status_code=404, detail="Task does not exist.")
+
+    async def _events():
+        async with worker.progress.subscribe(task_id) as queue:
+            # subscribed before reading the current state, so no state is missed
+            result = await worker.get_task_status(task_id)
+            yield f"data: {result.model_dump_json()}\n\n"
+            while result.status not in TERMINAL_STATUSES:
+                try:
+                    result = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {result.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/workers")
+async def get_workers() -> WorkerPoolStats:
+    return worker.get_worker_stats()
+
+
 @router.get("/download/{task_id}")
 async def download_video(task_id: str):
     result = await worker.get_task_status(task_id)
@@ -14,3 +14,38 @@ class WMRemoveResults(BaseModel):
     percentage: int
     status: Status
     download_url: str | None = None
+
+
+class WorkerStats(BaseModel):
+    worker_id: int
+    pid: int | None = None
+    task_id: str | None = None
+    tasks_done: int
+    tasks_failed: int
+    busy_seconds: float
+    # share of the time since the worker started spent on tasks
+    utilization: float
+
+
+class WorkerPoolStats(BaseModel):
+    queued_tasks: int
+    workers: list[WorkerStats]
+
+
+class ChunkedUploadCreate(BaseModel):
+    filename: str
+    size: int
+    # sha256 of the whole file, checked when the upload is finalized
+    sha256: str | None = None
+
+
+class ChunkedUploadStatus(BaseModel):
+    upload_id: str
+    filename: str
+    size: int
+    chunk_size: int
+    num_chunks: int
+    received_chunks: int
+    missing_chunks: list[int]
+    next_offset: int
+    complete: bool
@@ -0,0 +1,320 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from uuid import uuid4
+
+from loguru import logger
+
+from sorawm.configs import (
+    RESUMABLE_CHUNK_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_MAX_SIZE,
+    UPLOAD_TTL_SECONDS,
+)
+from sorawm.server.schemas import ChunkedUploadStatus
+from sorawm.utils.video_utils import sniff_video_container
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_UPLOAD_FILE = re.compile(r"^([0-9a-f]{32})\.(part|json|json\.tmp)$")
+
+
+class UploadBusyError(Exception):
+    """the upload is being finalized or removed"""
+
+
+class _UploadState:
+    """chunk writes in flight and closing of an upload, in this process"""
+
+    def __init__(self):
+        # serializes the sidecar updates
+        self.lock = asyncio.Lock()
+        self.writes = 0
+        self.idle = asyncio.Condition()
+        # "finalized" or "removed" while the upload is
+        self.closing: str | None = None
+
+
+class ChunkedUploadStore:
+    """Resumable uploads, sent as numbered chunks in any order.
+
+    Every upload is a sparse file of its final size, chunk `index` is written at
+    offset `index * chunk_size` with a positional write, so the chunks land in
+    place and nothing is assembled at the end. The received chunks are kept in a
+    json sidecar next to it, an upload survives a server restart and the client
+    resumes from `ChunkedUploadStatus.missing_chunks`. Uploads nothing was
+    written to for `ttl` seconds are removed by `cleanup`. The file IO runs in
+    threads, off the event loop.
+    """
+
+    def __init__(
+        self,
+        upload_dir: Path,
+        chunk_size: int = RESUMABLE_CHUNK_SIZE,
+        ttl: float = UPLOAD_TTL_SECONDS,
+        max_size: int = UPLOAD_MAX_SIZE,
+    ):
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.max_size = max_size
+        self._states: dict[str, _UploadState] = {}
+
+    def _part_path(self, upload_id: str) -> Path:
+        return self.upload_dir / f"{upload_id}.part"
+
+    def _meta_path(self, upload_id: str) -> Path:
+        return self.upload_dir / f"{upload_id}.json"
+
+    def _state(self, upload_id: str) -> _UploadState:
+        state = self._states.setdefault(upload_id, _UploadState())
+        if state.closing:
+            raise UploadBusyError(f"Upload {upload_id} is being {state.closing}")
+        return state
+
+    def _release(self, upload_id: str, state: _UploadState):
+        # only uploads in use are kept in memory
+        if not state.writes and not state.closing:
+            if self._states.get(upload_id) is state:
+                del self._states[upload_id]
+
+    async def _load(self, upload_id: str) -> dict:
+        if not _UPLOAD_ID.match(upload_id):
+            raise KeyError(upload_id)
+        meta_path = self._meta_path(upload_id)
+
+        def _read() -> dict:
+            try:
+                return json.loads(meta_path.read_text())
+            except FileNotFoundError:
+                raise KeyError(upload_id)
+
+        return await asyncio.to_thread(_read)
+
+    async def _save(self, upload_id: str, meta: dict):
+        meta_path = self._meta_path(upload_id)
+
+        def _write():
+            tmp_path = meta_path.with_suffix(".json.tmp")
+            tmp_path.write_text(json.dumps(meta))
+            os.replace(tmp_path, meta_path)
+
+        await asyncio.to_thread(_write)
+
+    def _status(self, upload_id: str, meta: dict) -> ChunkedUploadStatus:
+        num_chunks = -(-meta["size"] // meta["chunk_size"])
+        received = set(meta["received"])
+        missing = [idx for idx in range(num_chunks) if idx not in received]
+        return ChunkedUploadStatus(
+            upload_id=upload_id,
+            filename=meta["filename"],
+            size=meta["size"],
+            chunk_size=meta["chunk_size"],
+            num_chunks=num_chunks,
+            received_chunks=len(received),
+            missing_chunks=missing,
+            # the offset a sequential client resumes from
+            next_offset=missing[0] * meta["chunk_size"] if missing else meta["size"],
+            complete=not missing,
+        )
+
+    async def create(
+        self, filename: str, size: int, sha256: str | None = None
+    ) -> ChunkedUploadStatus:
+        if size <= 0:
+            raise ValueError("The upload size must be positive")
+        if size > self.max_size:
+            raise ValueError(f"The upload size is over {self.max_size} bytes")
+        await self.cleanup()
+        upload_id = uuid4().hex
+        part_path = self._part_path(upload_id)
+
+        def _allocate():
+            # a sparse file of the final size, the chunks are written in place
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+
+        await asyncio.to_thread(_allocate)
+        meta = {
+            "filename": Path(filename).name,
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "sha256": sha256.lower() if sha256 else None,
+            "received": [],
+        }
+        await self._save(upload_id, meta)
+        logger.info(f"Upload {upload_id} created: {filename}, {size} bytes")
+        return self._status(upload_id, meta)
+
+    async def status(self, upload_id: str) -> ChunkedUploadStatus:
+        return self._status(upload_id, await self._load(upload_id))
+
+    def _upload_files(self, upload_id: str) -> list[Path]:
+        return [
+            self._part_path(upload_id),
+            self._meta_path(upload_id),
+            self._meta_path(upload_id).with_suffix(".json.tmp"),
+        ]
+
+    def _last_write(self, upload_id: str) -> float:
+        mtime = 0.0
+        for path in self._upload_files(upload_id):
+            try:
+                mtime = max(mtime, path.stat().st_mtime)
+            except FileNotFoundError:
+                pass
+        return mtime
+
+    async def cleanup(self) -> int:
+        """remove the uploads nothing was written to for `ttl` seconds
+
+        Returns the number of removed uploads. Uploads in use are kept, and
+        chunks sent to one while it is removed get a UploadBusyError.
+        """
+
+        def _stale() -> set[str]:
+            upload_ids = set()
+            for path in self.upload_dir.iterdir():
+                if match := _UPLOAD_FILE.match(path.name):
+                    upload_ids.add(match.group(1))
+            return {
+                upload_id
+                for upload_id in upload_ids
+                if time.time() - self._last_write(upload_id) > self.ttl
+            }
+
+        stale = [
+            upload_id
+            for upload_id in await asyncio.to_thread(_stale)
+            if upload_id not in self._states
+        ]
+        for upload_id in stale:
+            self._states[upload_id] = _UploadState()
+            self._states[upload_id].closing = "removed"
+
+        def _remove() -> list[str]:
+            removed = []
+            for upload_id in stale:
+                # written to between the scan and the closing above
+                if time.time() - self._last_write(upload_id) <= self.ttl:
+                    continue
+                for path in self._upload_files(upload_id):
+                    path.unlink(missing_ok=True)
+                removed.append(upload_id)
+            return removed
+
+        try:
+            removed = await asyncio.to_thread(_remove)
+        finally:
+            for upload_id in stale:
+                self._states.pop(upload_id, None)
+        for upload_id in removed:
+            logger.info(f"Upload {upload_id} expired, removed")
+        return len(removed)
+
+    async def write_chunk(
+        self,
+        upload_id: str,
+        index: int,
+        offset: int,
+        data: bytes,
+        sha256: str | None = None,
+    ) -> ChunkedUploadStatus:
+        # registered before anything is awaited, `finalize` and `cleanup` wait
+        # for or skip the writes in flight, a later one gets a UploadBusyError,
+        # or a KeyError once the upload is gone
+        state = self._state(upload_id)
+        state.writes += 1
+        try:
+            meta = await self._load(upload_id)
+            chunk_size, size = meta["chunk_size"], meta["size"]
+            if not 0 <= index < -(-size // chunk_size):
+                raise ValueError(f"Chunk {index} is out of range")
+            if offset != index * chunk_size:
+                raise ValueError(f"Chunk {index} starts at {index * chunk_size}")
+            expected = min(chunk_size, size - offset)
+            if len(data) != expected:
+                raise ValueError(f"Chunk {index} has {len(data)} bytes, not {expected}")
+            if sha256 and hashlib.sha256(data).hexdigest() != sha256.lower():
+                raise ValueError(f"Chunk {index} checksum mismatch")
+
+            def _pwrite():
+                fd = os.open(self._part_path(upload_id), os.O_WRONLY)
+                try:
+                    os.pwrite(fd, data, offset)
+                finally:
+                    os.close(fd)
+
+            # chunks of one upload are written in parallel, only the sidecar
+            # update is serialized
+            await asyncio.to_thread(_pwrite)
+            async with state.lock:
+                meta = await self._load(upload_id)
+                if index not in meta["received"]:
+                    meta["received"].append(index)
+                    await self._save(upload_id, meta)
+                return self._status(upload_id, meta)
+        finally:
+            state.writes -= 1
+            async with state.idle:
+                state.idle.notify_all()
+            self._release(upload_id, state)
+
+    async def finalize(self, upload_id: str, video_path: Path) -> str:
+        """move the complete upload to `video_path`, returns its sha256
+
+        Chunk writes already in flight complete first, later ones are refused.
+        """
+        state = self._state(upload_id)
+        state.closing = "finalized"
+        try:
+            async with state.idle:
+                await state.idle.wait_for(lambda: not state.writes)
+            async with state.lock:
+                sha256 = await self._finalize(upload_id, video_path)
+        except BaseException:
+            state.closing = None
+            self._release(upload_id, state)
+            raise
+        # the files are gone, later requests for it get a KeyError
+        self._states.pop(upload_id, None)
+        logger.info(f"Upload {upload_id} finalized: {video_path.name}, sha256 {sha256}")
+        return sha256
+
+    async def _finalize(self, upload_id: str, video_path: Path) -> str:
+        meta = await self._load(upload_id)
+        status = self._status(upload_id, meta)
+        if not status.complete:
+            raise ValueError(
+                f"Upload {upload_id} misses chunks {status.missing_chunks}"
+            )
+        part_path = self._part_path(upload_id)
+
+        def _verify() -> str:
+            sha256 = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                head = f.read(UPLOAD_CHUNK_SIZE)
+                if sniff_video_container(head) is None:
+                    raise ValueError(f"{meta['filename']} is not a supported video")
+                sha256.update(head)
+                while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+            return sha256.hexdigest()
+
+        sha256 = await asyncio.to_thread(_verify)
+        if meta["sha256"] and sha256 != meta["sha256"]:
+            raise ValueError(f"Upload {upload_id} checksum mismatch")
+
+        def _complete():
+            # the chunks are already in place, a rename completes the file
+            os.replace(part_path, video_path)
+            self._meta_path(upload_id).unlink(missing_ok=True)
+
+        await asyncio.to_thread(_complete)
+        return sha256
+
+    async def filename(self, upload_id: str) -> str:
+        return (await self._load(upload_id))["filename"]
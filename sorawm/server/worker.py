@@ -1,32 +1,208 @@
 import asyncio
+import multiprocessing
+import os
+import threading
+import time
 from asyncio import Queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
 from uuid import uuid4
 
+import torch
 from loguru import logger
-from sqlalchemy import select
+from sqlalchemy import bindparam, select, update
 
-from sorawm.configs import WORKING_DIR
+from sorawm.configs import (
+    PROGRESS_FLUSH_SECONDS,
+    SERVER_NUM_WORKERS,
+    SERVER_RESTART_BACKOFF_SECONDS,
+    SERVER_RESTART_MAX_BACKOFF_SECONDS,
+    SERVER_SHUTDOWN_TIMEOUT_SECONDS,
+    SERVER_WORKER_THREADS,
+    WORKING_DIR,
+)
 from sorawm.core import SoraWM
+from sorawm.schemas import EncodeOptions
 from sorawm.server.db import get_session
 from sorawm.server.models import Task
-from sorawm.server.schemas import Status, WMRemoveResults
+from sorawm.server.progress import ProgressBroker
+from sorawm.server.schemas import (
+    Status,
+    WMRemoveResults,
+    WorkerPoolStats,
+    WorkerStats,
+)
+
+# models and progress queue of a worker process
+_process_sora_wm: SoraWM | None = None
+_process_progress_queue = None
+
+
+def _init_model_worker(progress_queue, num_threads: int):
+    global _process_sora_wm, _process_progress_queue
+    torch.set_num_threads(num_threads)
+    _process_progress_queue = progress_queue
+    _process_sora_wm = SoraWM()
+
+
+def _run_remove_task(
+    task_id: str,
+    video_path: Path,
+    output_path: Path,
+    encode_options: EncodeOptions | None,
+):
+    def progress_callback(percentage: int):
+        _process_progress_queue.put((task_id, percentage))
+
+    _process_sora_wm.run(video_path, output_path, progress_callback, encode_options)
+
+
+def _stop_executor(executor: ProcessPoolExecutor, timeout: float):
+    """cancel the queued calls and terminate the worker processes, a running
+    call is interrupted"""
+    # the executor has no public handle on its processes before python 3.14
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+class WorkerSlot:
+    """one model holding worker process and its utilization"""
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.executor: ProcessPoolExecutor | None = None
+        self.pid: int | None = None
+        self.task_id: str | None = None
+        self.task_started: float | None = None
+        self.tasks_done = 0
+        self.tasks_failed = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+
+    def stats(self) -> WorkerStats:
+        now = time.monotonic()
+        busy_seconds = self.busy_seconds
+        if self.task_started is not None:
+            busy_seconds += now - self.task_started
+        return WorkerStats(
+            worker_id=self.worker_id,
+            pid=self.pid,
+            task_id=self.task_id,
+            tasks_done=self.tasks_done,
+            tasks_failed=self.tasks_failed,
+            busy_seconds=round(busy_seconds, 3),
+            utilization=round(busy_seconds / max(now - self.started, 1e-9), 4),
+        )
 
 
 class WMRemoveTaskWorker:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        num_workers: int = SERVER_NUM_WORKERS,
+        worker_threads: int = SERVER_WORKER_THREADS,
+    ) -> None:
         self.queue = Queue()
-        self.sora_wm = None
+        self.num_workers = num_workers
+        # without a budget every process would use all the cores
+        self.worker_threads = worker_threads or max(
+            (os.cpu_count() or 1) // num_workers, 1
+        )
+        self.slots: list[WorkerSlot] = []
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.stopping = False
+        self.progress_queue = None
+        # task states for the event streams and status reads, the database is
+        # written on state transitions, progress only by `_flush_progress`
+        self.progress = ProgressBroker()
+        # latest percentage of each task not written to the database yet
+        self._pending_progress: dict[str, int] = {}
         self.output_dir = WORKING_DIR
         self.upload_dir = WORKING_DIR / "uploads"
         self.upload_dir.mkdir(exist_ok=True, parents=True)
 
     async def initialize(self):
-        logger.info("Initializing SoraWM models...")
-        self.sora_wm = SoraWM()
+        logger.info(
+            f"Initializing SoraWM models in {self.num_workers} worker processes, "
+            f"{self.worker_threads} threads each..."
+        )
+        self.progress_queue = self.mp_context.Queue()
+        # progress reported by the worker processes is written from the event loop
+        threading.Thread(
+            target=self._forward_progress,
+            args=(asyncio.get_running_loop(),),
+            daemon=True,
+        ).start()
+        self.slots = [WorkerSlot(worker_id) for worker_id in range(self.num_workers)]
+        # the first worker downloads the weights and exports the onnx models on
+        # its own, the others only load them
+        await self._start_slot(self.slots[0])
+        await asyncio.gather(*(self._start_slot(slot) for slot in self.slots[1:]))
         logger.info("SoraWM models initialized")
 
+    async def shutdown(self):
+        # the tasks interrupted below fail, their slots are not restarted
+        self.stopping = True
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(
+                    _stop_executor, slot.executor, SERVER_SHUTDOWN_TIMEOUT_SECONDS
+                )
+                for slot in self.slots
+                if slot.executor is not None
+            )
+        )
+        await self._flush_progress()
+        if self.progress_queue is not None:
+            self.progress_queue.put(None)
+
+    async def _start_slot(self, slot: WorkerSlot):
+        if slot.executor is not None:
+            # a broken pool still holds its queues and management thread
+            await asyncio.to_thread(
+                _stop_executor, slot.executor, SERVER_SHUTDOWN_TIMEOUT_SECONDS
+            )
+            slot.executor = None
+            slot.pid = None
+        slot.executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self.mp_context,
+            initializer=_init_model_worker,
+            initargs=(self.progress_queue, self.worker_threads),
+        )
+        # the first call returns once the process has loaded its models
+        slot.pid = await asyncio.get_running_loop().run_in_executor(
+            slot.executor, os.getpid
+        )
+        logger.info(f"Worker {slot.worker_id} ready, pid {slot.pid}")
+
+    async def _restart_slot(self, slot: WorkerSlot):
+        """start the slot again until it succeeds, with an exponential backoff"""
+        backoff = SERVER_RESTART_BACKOFF_SECONDS
+        while not self.stopping:
+            await asyncio.sleep(backoff)
+            try:
+                await self._start_slot(slot)
+                return
+            except Exception as e:
+                logger.exception(f"Worker {slot.worker_id} failed to restart: {e}")
+                backoff = min(backoff * 2, SERVER_RESTART_MAX_BACKOFF_SECONDS)
+
+    def _forward_progress(self, loop: asyncio.AbstractEventLoop):
+        while (item := self.progress_queue.get()) is not None:
+            task_id, percentage = item
+            asyncio.run_coroutine_threadsafe(
+                self._update_progress(task_id, percentage), loop
+            )
+
     async def create_task(self) -> str:
         task_uuid = str(uuid4())
         async with get_session() as session:
@@ -37,18 +213,25 @@ class WMRemoveTaskWorker:
                 percentage=0,
             )
             session.add(task)
+        self._publish(task_uuid, Status.UPLOADING, 0)
         logger.info(f"Task {task_uuid} created with UPLOADING status")
         return task_uuid
 
-    async def queue_task(self, task_id: str, video_path: Path):
+    async def queue_task(
+        self,
+        task_id: str,
+        video_path: Path,
+        encode_options: EncodeOptions | None = None,
+    ):
         async with get_session() as session:
             result = await session.execute(select(Task).where(Task.id == task_id))
             task = result.scalar_one()
             task.video_path = str(video_path)
             task.status = Status.PROCESSING
             task.percentage = 0
+        self._publish(task_id, Status.PROCESSING, 0)
 
-        self.queue.put_nowait((task_id, video_path))
+        self.queue.put_nowait((task_id, video_path, encode_options))
         logger.info(f"Task {task_id} queued for processing: {video_path}")
 
     async def mark_task_error(self, task_id: str, error_msg: str):
@@ -58,13 +241,43 @@ class WMRemoveTaskWorker:
             if task:
                 task.status = Status.ERROR
                 task.percentage = 0
+        self._publish(task_id, Status.ERROR, 0)
         logger.error(f"Task {task_id} marked as ERROR: {error_msg}")
 
+    def _publish(
+        self,
+        task_id: str,
+        status: Status,
+        percentage: int,
+        download_url: str | None = None,
+    ):
+        if status in (Status.FINISHED, Status.ERROR):
+            self._pending_progress.pop(task_id, None)
+        self.progress.publish(
+            task_id,
+            WMRemoveResults(
+                percentage=percentage, status=status, download_url=download_url
+            ),
+        )
+
     async def run(self):
         logger.info("Worker started, waiting for tasks...")
-        while True:
-            task_uuid, video_path = await self.queue.get()
-            logger.info(f"Processing task {task_uuid}: {video_path}")
+        await asyncio.gather(
+            self._flush_progress_periodically(),
+            *(self._run_slot(slot) for slot in self.slots),
+        )
+
+    async def _run_slot(self, slot: WorkerSlot):
+        # every idle worker takes the oldest queued task, so tasks start in
+        # submission order and none waits behind a busy worker
+        while not self.stopping:
+            task_uuid, video_path, encode_options = await self.queue.get()
+            logger.info(
+                f"Processing task {task_uuid} on worker {slot.worker_id}: {video_path}"
+            )
+            slot.task_id = task_uuid
+            slot.task_started = time.monotonic()
+            broken = False
 
             try:
                 timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -79,16 +292,15 @@ class WMRemoveTaskWorker:
                     task = result.scalar_one()
                     task.status = Status.PROCESSING
                     task.percentage = 10
+                self._publish(task_uuid, Status.PROCESSING, 10)
 
-                loop = asyncio.get_event_loop()
-
-                def progress_callback(percentage: int):
-                    asyncio.run_coroutine_threadsafe(
-                        self._update_progress(task_uuid, percentage), loop
-                    )
-
-                await asyncio.to_thread(
-                    self.sora_wm.run, video_path, output_path, progress_callback
+                await asyncio.get_running_loop().run_in_executor(
+                    slot.executor,
+                    _run_remove_task,
+                    task_uuid,
+                    video_path,
+                    output_path,
+                    encode_options,
                 )
 
                 async with get_session() as session:
@@ -100,36 +312,82 @@ class WMRemoveTaskWorker:
                     task.percentage = 100
                     task.output_path = str(output_path)
                     task.download_url = f"/download/{task_uuid}"
+                self._publish(task_uuid, Status.FINISHED, 100, f"/download/{task_uuid}")
 
                 logger.info(
                     f"Task {task_uuid} completed successfully, output: {output_path}"
                 )
+                slot.tasks_done += 1
 
             except Exception as e:
                 logger.error(f"Error processing task {task_uuid}: {e}")
-                async with get_session() as session:
-                    result = await session.execute(
-                        select(Task).where(Task.id == task_uuid)
-                    )
-                    task = result.scalar_one()
-                    task.status = Status.ERROR
-                    task.percentage = 0
+                slot.tasks_failed += 1
+                broken = isinstance(e, BrokenProcessPool)
+                # the failure is recorded before the slot restarts, which can
+                # take long or fail again
+                try:
+                    await self.mark_task_error(task_uuid, str(e))
+                except Exception as db_error:
+                    logger.error(f"Error marking task {task_uuid} failed: {db_error}")
+                    self._publish(task_uuid, Status.ERROR, 0)
 
             finally:
+                slot.busy_seconds += time.monotonic() - slot.task_started
+                slot.task_id = None
+                slot.task_started = None
                 self.queue.task_done()
 
+            if broken and not self.stopping:
+                logger.warning(f"Worker {slot.worker_id} died, restarting it")
+                await self._restart_slot(slot)
+
+    def get_worker_stats(self) -> WorkerPoolStats:
+        return WorkerPoolStats(
+            queued_tasks=self.queue.qsize(),
+            workers=[slot.stats() for slot in self.slots],
+        )
+
     async def _update_progress(self, task_id: str, percentage: int):
+        if self.progress.publish_progress(task_id, percentage):
+            # a later percentage of the same task replaces this one before a flush
+            self._pending_progress[task_id] = percentage
+
+    async def _flush_progress_periodically(self):
+        while True:
+            await asyncio.sleep(PROGRESS_FLUSH_SECONDS)
+            await self._flush_progress()
+
+    async def _flush_progress(self):
+        """write the pending percentages of all tasks in one batched update"""
+        if not self._pending_progress:
+            return
+        pending, self._pending_progress = self._pending_progress, {}
+        tasks = Task.__table__
         try:
             async with get_session() as session:
-                result = await session.execute(select(Task).where(Task.id == task_id))
-                task = result.scalar_one_or_none()
-                if task:
-                    task.percentage = percentage
-                    logger.debug(f"Task {task_id} progress updated to {percentage}%")
+                # progress from a worker process can arrive after the task ended,
+                # the conditional update can not overwrite the final state
+                await session.execute(
+                    update(tasks)
+                    .where(
+                        tasks.c.id == bindparam("task_id"),
+                        tasks.c.status == Status.PROCESSING,
+                    )
+                    .values(percentage=bindparam("new_percentage")),
+                    [
+                        {"task_id": task_id, "new_percentage": percentage}
+                        for task_id, percentage in pending.items()
+                    ],
+                )
+            logger.debug(f"Progress of {len(pending)} tasks written")
         except Exception as e:
-            logger.error(f"Error updating progress for task {task_id}: {e}")
+            logger.error(f"Error writing the progress of {len(pending)} tasks: {e}")
 
     async def get_task_status(self, task_id: str) -> WMRemoveResults | None:
+        # tasks in flight are served from memory, without a database round trip
+        latest = self.progress.latest(task_id)
+        if latest is not None:
+            return latest
         async with get_session() as session:
             result = await session.execute(select(Task).where(Task.id == task_id))
             task = result.scalar_one_or_none()
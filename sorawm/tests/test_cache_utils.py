@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from sorawm.utils.cache_utils import DetectionCache
+
+PARAMS = {"backend": "torch", "use_roi": True}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DetectionCache(tmp_path / "cache")
+
+
+@pytest.fixture
+def weights_path(tmp_path):
+    weights_path = tmp_path / "best.pt"
+    weights_path.write_bytes(b"weights")
+    return weights_path
+
+
+def write_video(path, middle: bytes):
+    # same size, header and trailer, only the middle differs
+    path.write_bytes(b"head" * 1024 * 1024 + middle + b"tail" * 1024 * 1024)
+    return path
+
+
+def test_key_covers_the_whole_video(cache, weights_path, tmp_path):
+    a = write_video(tmp_path / "a.mp4", b"a" * 1024)
+    b = write_video(tmp_path / "b.mp4", b"b" * 1024)
+    copy = write_video(tmp_path / "copy.mp4", b"a" * 1024)
+    assert cache.key(a, weights_path, PARAMS) != cache.key(b, weights_path, PARAMS)
+    assert cache.key(a, weights_path, PARAMS) == cache.key(copy, weights_path, PARAMS)
+
+
+def test_key_follows_changes(cache, weights_path, tmp_path):
+    video = write_video(tmp_path / "a.mp4", b"a" * 1024)
+    key = cache.key(video, weights_path, PARAMS)
+    assert cache.key(video, weights_path, {**PARAMS, "use_roi": False}) != key
+
+    # the memoized digest is dropped once the file changes
+    stat = video.stat()
+    write_video(video, b"b" * 1024)
+    os.utime(video, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.key(video, weights_path, PARAMS) != key
+
+
+def test_save_and_load(cache):
+    bboxes = [(1, 2, 3, 4), None, (5, 6, 7, 8)]
+    imputed = [(1, 2, 3, 4), (1, 2, 3, 4), (5, 6, 7, 8)]
+    cache.save("key", bboxes, [0.9, None, 0.8], imputed)
+    cached = cache.load("key")
+    assert cached.bboxes == bboxes
+    assert cached.imputed_bboxes == imputed
+    assert cached.confidences[1] is None
+    assert cache.load("missing") is None
@@ -0,0 +1,173 @@
+import shutil
+import subprocess
+
+import ffmpeg
+import pytest
+
+pytest.importorskip("torch")
+
+from sorawm.core import SoraWM
+from sorawm.schemas import EncodeOptions
+from sorawm.utils.video_utils import (
+    H264_NAL_IDR_SLICE,
+    H264_NAL_SLICE,
+    VideoLoader,
+    get_keyframe_indices,
+    h264_slice_nal_type,
+)
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+    reason="needs ffmpeg and ffprobe",
+)
+
+FPS = 25
+GOP = 25
+NUM_FRAMES = 100
+BBOX = (10, 10, 60, 40)
+
+
+class PassThroughCleaner:
+    patch_cache = None
+    temporal = False
+
+    def reset_temporal(self):
+        pass
+
+    def clean_patch_batch(self, frames, bboxes):
+        return [None] * len(frames)
+
+
+@pytest.fixture
+def sora_wm():
+    # only the segment pass runs, no model is loaded
+    sora_wm = SoraWM.__new__(SoraWM)
+    sora_wm.cleaner = PassThroughCleaner()
+    sora_wm.detect_batch_size = 4
+    sora_wm.clean_batch_size = 4
+    sora_wm.detect_keyframe_interval = None
+    return sora_wm
+
+
+def make_source(path, profile: str, level: str, x264_params: str = "scenecut=0"):
+    # encoder settings unlike the EncodeOptions ones, so the parameter sets of
+    # the copied and the encoded GOPs differ in everything but profile and level
+    (
+        ffmpeg.input(
+            f"testsrc=size=320x240:rate={FPS}", format="lavfi", t=NUM_FRAMES / FPS
+        )
+        .output(
+            str(path),
+            vcodec="libx264",
+            pix_fmt="yuv420p",
+            preset="veryfast",
+            **{
+                "profile:v": profile,
+                "level": level,
+                "x264-params": f"keyint={GOP}:min-keyint={GOP}:ref=1:{x264_params}",
+            },
+        )
+        .overwrite_output()
+        .global_args("-loglevel", "error")
+        .run()
+    )
+
+
+def decoded_frames(path) -> int:
+    decode = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", str(path), "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+    )
+    assert decode.returncode == 0 and not decode.stderr, decode.stderr
+    probe = ffmpeg.probe(str(path), select_streams="v:0", count_frames=None)
+    return int(probe["streams"][0]["nb_read_frames"])
+
+
+@pytest.mark.parametrize(
+    "profile, level", [("baseline", "3.0"), ("main", "3.1"), ("high", "4.0")]
+)
+def test_copied_and_encoded_segments_decode(sora_wm, tmp_path, profile, level):
+    source_path = tmp_path / "source.mp4"
+    output_path = tmp_path / "output.mp4"
+    make_source(source_path, profile, level)
+    loader = VideoLoader(source_path)
+    # a watermark on the second GOP only
+    bboxes = [BBOX if GOP <= idx < 2 * GOP else None for idx in range(NUM_FRAMES)]
+
+    segments = sora_wm._plan_copy_segments(loader, bboxes, EncodeOptions())
+    assert segments == [
+        (0, GOP, True),
+        (GOP, 2 * GOP, False),
+        (2 * GOP, NUM_FRAMES, True),
+    ]
+    copied_frames = sora_wm._write_segments(
+        loader, bboxes, segments, output_path, EncodeOptions()
+    )
+
+    assert copied_frames == NUM_FRAMES - GOP
+    assert decoded_frames(output_path) == NUM_FRAMES
+    output_loader = VideoLoader(output_path)
+    assert (output_loader.profile, output_loader.level) == (
+        loader.profile,
+        loader.level,
+    )
+
+
+@pytest.mark.parametrize(
+    "encode_options",
+    [
+        EncodeOptions(profile="main"),
+        EncodeOptions(level="3.1"),
+        EncodeOptions(codec="libx265"),
+        EncodeOptions(pix_fmt="yuv444p"),
+    ],
+)
+def test_mismatched_encoder_disables_copy(sora_wm, tmp_path, encode_options):
+    source_path = tmp_path / "source.mp4"
+    make_source(source_path, "high", "4.0")
+    loader = VideoLoader(source_path)
+    bboxes = [BBOX if idx < GOP else None for idx in range(NUM_FRAMES)]
+
+    assert sora_wm._plan_copy_segments(loader, bboxes, encode_options) is None
+
+
+def test_open_gops_are_not_cut(sora_wm, tmp_path):
+    source_path = tmp_path / "source.mp4"
+    # the I pictures after the first one are not IDR ones
+    make_source(source_path, "high", "4.0", "scenecut=0:open-gop=1:bframes=2")
+    loader = VideoLoader(source_path)
+    assert get_keyframe_indices(source_path, FPS) == [0, GOP, 2 * GOP, 3 * GOP]
+    assert get_keyframe_indices(source_path, FPS, idr_only=True) == [0]
+    bboxes = [BBOX if GOP <= idx < 2 * GOP else None for idx in range(NUM_FRAMES)]
+
+    assert sora_wm._plan_copy_segments(loader, bboxes, EncodeOptions()) is None
+
+
+def test_closed_gops_with_b_frames_are_cut(sora_wm, tmp_path):
+    source_path = tmp_path / "source.mp4"
+    make_source(source_path, "high", "4.0", "scenecut=0:bframes=2")
+    assert get_keyframe_indices(source_path, FPS, idr_only=True) == [
+        0,
+        GOP,
+        2 * GOP,
+        3 * GOP,
+    ]
+
+
+@pytest.mark.parametrize("start_code", [b"\x00\x00\x00\x01", b"\x00\x00\x01"])
+def test_slice_nal_type_annex_b(start_code):
+    sei, idr, slice_ = b"\x06\x05\x01", b"\x65\x88", b"\x41\x9a"
+    assert h264_slice_nal_type(start_code + sei + start_code + idr) == (
+        H264_NAL_IDR_SLICE
+    )
+    assert h264_slice_nal_type(start_code + slice_) == H264_NAL_SLICE
+    assert h264_slice_nal_type(start_code + sei) is None
+
+
+def test_slice_nal_type_length_prefixed():
+    sei, idr = b"\x06\x05\x01", b"\x65\x88"
+    data = b"".join(len(unit).to_bytes(4, "big") + unit for unit in (sei, idr))
+    assert h264_slice_nal_type(data) == H264_NAL_IDR_SLICE
+    # a truncated unit is not taken for a slice
+    assert h264_slice_nal_type(data[:-2]) is None
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from sorawm.configs import IMPUTE_BKPS_NOISE_HISTORY, IMPUTE_BKPS_WINDOW
+from sorawm.utils.imputation_utils import (
+    StreamingBkpsDetector,
+    find_2d_data_bkps,
+    impute_missed_bboxes,
+)
+
+
+def make_centers(segments, noise=2.0, missing=0.0, seed=0):
+    """bbox centers jittered around the (x, y) level of each (level, length) segment"""
+    rng = np.random.default_rng(seed)
+    centers = []
+    for (x, y), length in segments:
+        for _ in range(length):
+            if rng.random() < missing:
+                centers.append(None)
+            else:
+                centers.append(
+                    (int(x + rng.normal(0, noise)), int(y + rng.normal(0, noise)))
+                )
+    return centers
+
+
+def streaming_bkps(centers):
+    detector = StreamingBkpsDetector()
+    for center in centers:
+        detector.update(center)
+    return detector.finalize()
+
+
+def test_step_changes():
+    centers = make_centers([((100, 100), 60), ((600, 80), 45), ((120, 500), 70)])
+    assert find_2d_data_bkps(centers) == [60, 105]
+
+
+def test_step_changes_with_missing_points():
+    centers = make_centers(
+        [((100, 100), 60), ((600, 80), 45), ((120, 500), 70)], missing=0.2
+    )
+    assert find_2d_data_bkps(centers) == [60, 105]
+
+
+def test_segment_of_window_length():
+    centers = make_centers(
+        [((100, 100), 60), ((400, 300), IMPUTE_BKPS_WINDOW), ((100, 100), 60)]
+    )
+    assert find_2d_data_bkps(centers) == [60, 60 + IMPUTE_BKPS_WINDOW]
+
+
+@pytest.mark.parametrize("length", [1, 5, IMPUTE_BKPS_WINDOW - 1])
+def test_short_segment_is_merged(length):
+    centers = make_centers([((100, 100), 60), ((400, 300), length), ((100, 100), 60)])
+    bkps = find_2d_data_bkps(centers)
+    # change points are at least a window apart, both ends of a shorter segment
+    # can not be found
+    assert len(bkps) <= 2
+    assert np.all(np.diff(bkps) >= IMPUTE_BKPS_WINDOW)
+    assert not {60, 60 + length} <= set(bkps)
+
+
+def test_all_none():
+    assert find_2d_data_bkps([None] * 50) == []
+    assert streaming_bkps([None] * 50) == []
+    bboxes = [None] * 50
+    assert impute_missed_bboxes(bboxes) == bboxes
+
+
+@pytest.mark.parametrize("num_points", [0, 1, 2, 10])
+def test_few_points(num_points):
+    centers = make_centers([((100, 100), num_points)])
+    assert find_2d_data_bkps(centers) == []
+    assert streaming_bkps(centers) == []
+
+
+@pytest.mark.parametrize("noise", [0.0, 2.0, 8.0])
+def test_noise_only(noise):
+    centers = make_centers([((300, 200), 500)], noise=noise)
+    assert find_2d_data_bkps(centers) == []
+
+
+@pytest.mark.parametrize(
+    "segments",
+    [
+        [((100, 100), 60), ((600, 80), 45), ((120, 500), 70)],
+        [((100, 100), 60), ((400, 300), 10), ((100, 100), 60)],
+        [((300, 200), 500)],
+        # the streaming noise scale starts dropping the oldest differences past
+        # IMPUTE_BKPS_NOISE_HISTORY points, change points on both sides of it
+        [
+            ((100, 100), IMPUTE_BKPS_NOISE_HISTORY - 20),
+            ((500, 300), 40),
+            ((100, 400), 300),
+        ],
+        [((100, 100), IMPUTE_BKPS_NOISE_HISTORY - 1), ((500, 300), 60)],
+        [((100, 100), IMPUTE_BKPS_NOISE_HISTORY), ((500, 300), 60)],
+        [((100, 100), IMPUTE_BKPS_NOISE_HISTORY + 1), ((500, 300), 60)],
+        [((100, 100), 700), ((500, 300), 700), ((100, 400), 700)],
+    ],
+)
+@pytest.mark.parametrize("missing", [0.0, 0.3])
+def test_streaming_matches_batch(segments, missing):
+    centers = make_centers(segments, missing=missing)
+    assert streaming_bkps(centers) == find_2d_data_bkps(centers)
+
+
+def test_impute_missed_bboxes():
+    bboxes = [(10, 10, 50, 30)] * 40 + [(500, 300, 540, 320)] * 40
+    bboxes[5] = bboxes[60] = None
+    imputed = impute_missed_bboxes(bboxes)
+    assert imputed[5] == (10, 10, 50, 30)
+    assert imputed[60] == (500, 300, 540, 320)
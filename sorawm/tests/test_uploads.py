@@ -0,0 +1,140 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from sorawm.server.uploads import ChunkedUploadStore, UploadBusyError
+
+CHUNK_SIZE = 64
+# an iso bmff head, the rest of the file does not matter to the upload
+VIDEO = (b"\x00\x00\x00\x18ftypmp42" + bytes(range(256)) * 2)[:200]
+
+
+def chunks(data: bytes):
+    for index in range(0, -(-len(data) // CHUNK_SIZE)):
+        yield index, data[index * CHUNK_SIZE : (index + 1) * CHUNK_SIZE]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkedUploadStore(tmp_path, chunk_size=CHUNK_SIZE, ttl=3600)
+
+
+def upload_files(store, upload_id):
+    return sorted(
+        path.name for path in store.upload_dir.iterdir() if upload_id in path.name
+    )
+
+
+def test_upload_and_finalize(store, tmp_path):
+    async def _run():
+        upload_id = (await store.create("a.mp4", len(VIDEO))).upload_id
+        # in any order and in parallel
+        await asyncio.gather(
+            *(
+                store.write_chunk(upload_id, index, index * CHUNK_SIZE, data)
+                for index, data in reversed(list(chunks(VIDEO)))
+            )
+        )
+        assert (await store.status(upload_id)).complete
+        await store.finalize(upload_id, tmp_path / "a.mp4")
+        return upload_id
+
+    upload_id = asyncio.run(_run())
+    assert (tmp_path / "a.mp4").read_bytes() == VIDEO
+    assert upload_files(store, upload_id) == []
+    assert store._states == {}
+
+
+def test_finalized_upload_is_gone(store, tmp_path):
+    async def _run():
+        upload_id = (await store.create("a.mp4", len(VIDEO))).upload_id
+        for index, data in chunks(VIDEO):
+            await store.write_chunk(upload_id, index, index * CHUNK_SIZE, data)
+        await store.finalize(upload_id, tmp_path / "a.mp4")
+        with pytest.raises(KeyError):
+            await store.write_chunk(upload_id, 0, 0, VIDEO[:CHUNK_SIZE])
+        with pytest.raises(KeyError):
+            await store.finalize(upload_id, tmp_path / "b.mp4")
+
+    asyncio.run(_run())
+
+
+def test_finalize_waits_for_writes_in_flight(store, tmp_path, monkeypatch):
+    release = threading.Event()
+    pwrite = os.pwrite
+
+    def _blocked_pwrite(fd, data, offset):
+        release.wait(5)
+        return pwrite(fd, data, offset)
+
+    async def _run():
+        upload_id = (await store.create("a.mp4", len(VIDEO))).upload_id
+        *first, (last_index, last_data) = chunks(VIDEO)
+        for index, data in first:
+            await store.write_chunk(upload_id, index, index * CHUNK_SIZE, data)
+        monkeypatch.setattr(os, "pwrite", _blocked_pwrite)
+        last = asyncio.create_task(
+            store.write_chunk(upload_id, last_index, last_index * CHUNK_SIZE, last_data)
+        )
+        await asyncio.sleep(0.05)
+        finalize = asyncio.create_task(store.finalize(upload_id, tmp_path / "a.mp4"))
+        await asyncio.sleep(0.05)
+        assert not finalize.done()
+        # chunks and finalizes sent while it runs are refused
+        with pytest.raises(UploadBusyError):
+            await store.write_chunk(upload_id, 0, 0, VIDEO[:CHUNK_SIZE])
+        with pytest.raises(UploadBusyError):
+            await store.finalize(upload_id, tmp_path / "b.mp4")
+        release.set()
+        await last
+        await finalize
+
+    asyncio.run(_run())
+    assert (tmp_path / "a.mp4").read_bytes() == VIDEO
+    assert not (tmp_path / "b.mp4").exists()
+
+
+def test_failed_finalize_can_be_retried(store, tmp_path):
+    async def _run():
+        upload_id = (await store.create("a.mp4", len(VIDEO))).upload_id
+        *first, (last_index, last_data) = chunks(VIDEO)
+        for index, data in first:
+            await store.write_chunk(upload_id, index, index * CHUNK_SIZE, data)
+        with pytest.raises(ValueError, match="misses chunks"):
+            await store.finalize(upload_id, tmp_path / "a.mp4")
+        await store.write_chunk(
+            upload_id, last_index, last_index * CHUNK_SIZE, last_data
+        )
+        await store.finalize(upload_id, tmp_path / "a.mp4")
+
+    asyncio.run(_run())
+    assert (tmp_path / "a.mp4").read_bytes() == VIDEO
+
+
+def test_cleanup_removes_stale_uploads(store):
+    stale_id = asyncio.run(store.create("stale.mp4", len(VIDEO))).upload_id
+    fresh_id = asyncio.run(store.create("fresh.mp4", len(VIDEO))).upload_id
+    long_ago = time.time() - 2 * store.ttl
+    for path in store.upload_dir.iterdir():
+        if stale_id in path.name:
+            os.utime(path, (long_ago, long_ago))
+    (store.upload_dir / "other_video.mp4").write_bytes(VIDEO)
+
+    assert asyncio.run(store.cleanup()) == 1
+    assert upload_files(store, stale_id) == []
+    assert upload_files(store, fresh_id) == [f"{fresh_id}.json", f"{fresh_id}.part"]
+    assert (store.upload_dir / "other_video.mp4").exists()
+    assert store._states == {}
+    with pytest.raises(KeyError):
+        asyncio.run(store.status(stale_id))
+
+
+def test_too_large_upload_is_refused(tmp_path):
+    store = ChunkedUploadStore(tmp_path, chunk_size=CHUNK_SIZE, max_size=len(VIDEO))
+    assert asyncio.run(store.create("a.mp4", len(VIDEO))).num_chunks == 4
+    with pytest.raises(ValueError, match="over"):
+        asyncio.run(store.create("a.mp4", len(VIDEO) + 1))
+    assert len(list(tmp_path.iterdir())) == 2
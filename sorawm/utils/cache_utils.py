@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from sorawm.configs import (
+    DETECTION_CACHE_DIR,
+    DETECTION_CACHE_MAX_BYTES,
+    PATCH_CACHE_THUMBNAIL,
+    PATCH_CACHE_TOLERANCE,
+)
+
+# bump when the stored arrays or the imputation change meaning, older entries are
+# then ignored
+DETECTION_CACHE_VERSION = 1
+
+Bbox = tuple[int, int, int, int]
+
+
+def file_digest(path: Path) -> str:
+    """blake2b of the file content, hashed in large chunks"""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(
+            f, lambda: hashlib.blake2b(digest_size=16)
+        ).hexdigest()
+
+
+@lru_cache()
+def _cached_file_digest(path: Path, size: int, mtime_ns: int) -> str:
+    return file_digest(path)
+
+
+def cached_file_digest(path: Path) -> str:
+    """`file_digest`, computed once per process until the file changes"""
+    stat = path.stat()
+    return _cached_file_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+class CachedDetections(NamedTuple):
+    bboxes: list[Bbox | None]
+    confidences: list[float | None]
+    imputed_bboxes: list[Bbox | None]
+
+
+def _bboxes_to_array(bboxes: list[Bbox | None]) -> np.ndarray:
+    array = np.full((len(bboxes), 4), -1, dtype=np.int32)
+    for idx, bbox in enumerate(bboxes):
+        if bbox is not None:
+            array[idx] = bbox
+    return array
+
+
+def _array_to_bboxes(array: np.ndarray) -> list[Bbox | None]:
+    return [tuple(row) if row[0] >= 0 else None for row in array.astype(int).tolist()]
+
+
+class DetectionCache:
+    """Detection results of whole videos on disk, one .npz file per key.
+
+    The key is the hash of the video, the hash of the detector weights and the
+    detection and imputation settings, so a rerun on the same upload skips the
+    detection pass and a changed detector never reads stale results. Bboxes are stored as
+    int32 rows with -1 for the frames without one, confidences as float32 with
+    nan. Entries are touched when read, and the least recently used ones are
+    removed once the cache holds more than `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DETECTION_CACHE_DIR,
+        max_bytes: int = DETECTION_CACHE_MAX_BYTES,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, video_path: Path, weights_path: Path, params: dict) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        # the whole content, videos of the same size can differ anywhere
+        digest.update(cached_file_digest(video_path).encode())
+        digest.update(cached_file_digest(weights_path).encode())
+        digest.update(
+            json.dumps(
+                {"version": DETECTION_CACHE_VERSION, **params}, sort_keys=True
+            ).encode()
+        )
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.npz"
+
+    def load(self, key: str) -> CachedDetections | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                confidences = data["confidences"]
+                cached = CachedDetections(
+                    bboxes=_array_to_bboxes(data["bboxes"]),
+                    confidences=[
+                        None if np.isnan(c) else float(c) for c in confidences
+                    ],
+                    imputed_bboxes=_array_to_bboxes(data["imputed_bboxes"]),
+                )
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable detection cache {path}: {e}")
+            return None
+        # the modification time orders the entries for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return cached
+
+    def save(
+        self,
+        key: str,
+        bboxes: list[Bbox | None],
+        confidences: list[float | None],
+        imputed_bboxes: list[Bbox | None],
+    ):
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            bboxes=_bboxes_to_array(bboxes),
+            confidences=np.array(
+                [np.nan if c is None else c for c in confidences], dtype=np.float32
+            ),
+            imputed_bboxes=_bboxes_to_array(imputed_bboxes),
+        )
+        # readers never see a half written entry
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used entries beyond `max_bytes`"""
+        entries = []
+        for path in self.cache_dir.glob("*.npz"):
+            if ".tmp." in path.name:
+                # being written by another process
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.debug(f"Evicted detection cache {path.name}")
+
+
+def context_fingerprint(
+    crop_image: np.ndarray,
+    crop_mask: np.ndarray,
+    size: int = PATCH_CACHE_THUMBNAIL,
+) -> np.ndarray:
+    """gray thumbnail of the crop with the masked area blanked, the context only"""
+    gray = cv2.cvtColor(crop_image, cv2.COLOR_BGR2GRAY)
+    gray[crop_mask > 0] = 0
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(
+        np.float32
+    )
+
+
+class PatchCache:
+    """Bounded LRU of inpainted patches, keyed by the crop window, the bbox and the
+    fingerprint of the context around it.
+
+    The inpainted area only depends on the context, so a frame of a static shot
+    whose fingerprint matches a cached one within `tolerance` reuses that patch.
+    """
+
+    def __init__(self, max_size: int, tolerance: float = PATCH_CACHE_TOLERANCE):
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, fingerprint: np.ndarray) -> np.ndarray | None:
+        for entry_id, (entry_key, entry_fingerprint, patch) in reversed(
+            self._entries.items()
+        ):
+            if (
+                entry_key == key
+                and np.abs(entry_fingerprint - fingerprint).max() <= self.tolerance
+            ):
+                self._entries.move_to_end(entry_id)
+                self.hits += 1
+                return patch
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, fingerprint: np.ndarray, patch: np.ndarray):
+        self._entries[self._next_id] = (key, fingerprint, patch)
+        self._next_id += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
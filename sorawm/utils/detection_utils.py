@@ -0,0 +1,167 @@
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+
+Box = Tuple[int, int, int, int]
+
+
+def roi_to_pixels(
+    roi: Tuple[float, float, float, float], width: int, height: int
+) -> Box:
+    """convert a (x1, y1, x2, y2) roi given in fractions of the frame to pixels"""
+    x1, y1, x2, y2 = roi
+    return (
+        max(int(x1 * width), 0),
+        max(int(y1 * height), 0),
+        min(int(round(x2 * width)), width),
+        min(int(round(y2 * height)), height),
+    )
+
+
+def expand_bbox(bbox: Box, ratio: float, width: int, height: int) -> Box:
+    """grow the bbox by `ratio` of its own size on every side, clipped to the frame"""
+    x1, y1, x2, y2 = bbox
+    pad_x = int((x2 - x1) * ratio)
+    pad_y = int((y2 - y1) * ratio)
+    return (
+        max(x1 - pad_x, 0),
+        max(y1 - pad_y, 0),
+        min(x2 + pad_x, width),
+        min(y2 + pad_y, height),
+    )
+
+
+def bbox_inside(bbox: Box, region: Box) -> bool:
+    return (
+        bbox[0] >= region[0]
+        and bbox[1] >= region[1]
+        and bbox[2] <= region[2]
+        and bbox[3] <= region[3]
+    )
+
+
+def touches_inner_border(
+    bbox: Box, region: Box, width: int, height: int, margin: int = 0
+) -> bool:
+    """whether the bbox reaches a border of the region that is not a frame edge"""
+    return (
+        (region[0] > 0 and bbox[0] <= region[0] + margin)
+        or (region[1] > 0 and bbox[1] <= region[1] + margin)
+        or (region[2] < width and bbox[2] >= region[2] - margin)
+        or (region[3] < height and bbox[3] >= region[3] - margin)
+    )
+
+
+def roi_inference_size(roi: Box, scale: float, stride: int = 32) -> Tuple[int, int]:
+    """(h, w) inference size of a roi crop resized by `scale`, rounded up to the stride"""
+    x1, y1, x2, y2 = roi
+
+    def _ceil(v: float) -> int:
+        return max(int(-(-v // stride)) * stride, stride)
+
+    return _ceil((y2 - y1) * scale), _ceil((x2 - x1) * scale)
+
+
+def letterbox(
+    image: np.ndarray, shape: Tuple[int, int], stride: int = 32, auto: bool = True
+) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """resize keeping the aspect ratio into (h, w) and pad the rest with gray
+
+    With `auto` the padding only reaches the next multiple of `stride`, as the
+    ultralytics predictor does. Returns the image, the resize ratio and the
+    (left, top) padding.
+    """
+    height, width = image.shape[:2]
+    ratio = min(shape[0] / height, shape[1] / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    pad_w, pad_h = shape[1] - new_width, shape[0] - new_height
+    if auto:
+        pad_w, pad_h = pad_w % stride, pad_h % stride
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(
+            image, (new_width, new_height), interpolation=cv2.INTER_LINEAR
+        )
+    top, left = int(round(pad_h / 2 - 0.1)), int(round(pad_w / 2 - 0.1))
+    bottom, right = int(round(pad_h / 2 + 0.1)), int(round(pad_w / 2 + 0.1))
+    image = cv2.copyMakeBorder(
+        image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114)
+    )
+    return image, ratio, (left, top)
+
+
+def merge_rois(rois: List[Box], roi: Box, max_rois: int) -> List[Box]:
+    """append a roi, dropping the oldest ones beyond `max_rois`"""
+    rois = [it for it in rois if not bbox_inside(it, roi)] + [roi]
+    return rois[-max_rois:]
+
+
+def bbox_iou(a: Box, b: Box) -> float:
+    inter_w = min(a[2], b[2]) - max(a[0], b[0])
+    inter_h = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def bboxes_agree(a: Box | None, b: Box | None, iou_threshold: float) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return bbox_iou(a, b) >= iou_threshold
+
+
+Detection = Tuple[Box | None, float | None]
+
+
+def keyframe_detect(
+    frames: Iterable[np.ndarray],
+    detect_fn: Callable[[np.ndarray], Detection],
+    interval: int,
+    iou_threshold: float,
+) -> Iterator[Detection]:
+    """Run `detect_fn` every `interval` frames and only bisect where two samples disagree.
+
+    The frames between two agreeing samples get the bbox of the first one with a
+    None confidence, so the detection cost grows with the number of watermark
+    jumps instead of the number of frames. At most `interval + 1` frames are kept.
+    Yields one (bbox, confidence) per frame, in order.
+    """
+
+    def _bisect(window, results, lo, hi):
+        if hi - lo <= 1:
+            return
+        if bboxes_agree(results[lo][0], results[hi][0], iou_threshold):
+            for idx in range(lo + 1, hi):
+                results[idx] = (results[lo][0], None)
+            return
+        mid = (lo + hi) // 2
+        results[mid] = detect_fn(window[mid])
+        _bisect(window, results, lo, mid)
+        _bisect(window, results, mid, hi)
+
+    def _resolve(window, head):
+        results = [None] * len(window)
+        results[0] = head
+        if len(window) > 1:
+            results[-1] = detect_fn(window[-1])
+            _bisect(window, results, 0, len(window) - 1)
+        return results
+
+    window = []
+    head = None
+    for frame in frames:
+        window.append(frame)
+        if head is None:
+            head = detect_fn(frame)
+            continue
+        if len(window) <= interval:
+            continue
+        results = _resolve(window, head)
+        yield from results[:-1]
+        window = window[-1:]
+        head = results[-1]
+
+    if window:
+        yield from _resolve(window, head)
@@ -1,52 +1,312 @@
-import ruptures as rpt
-import numpy as np
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
+import math
+from collections import deque
 from typing import List, Tuple
 
+import numpy as np
+from loguru import logger
+
+from sorawm.configs import (
+    IMPUTE_BKPS_MIN_SHIFT,
+    IMPUTE_BKPS_NOISE_HISTORY,
+    IMPUTE_BKPS_NOISE_Z,
+    IMPUTE_BKPS_WINDOW,
+)
+
+
+def interpolate_missing(X: List[Tuple[int, int] | None]) -> np.ndarray:
+    """(n, 2) float array of the points, the None gaps linearly interpolated"""
+    X = np.array(
+        [point if point is not None else (np.nan, np.nan) for point in X], dtype=float
+    ).reshape(-1, 2)
+    valid = ~np.isnan(X[:, 0])
+    if valid.any() and not valid.all():
+        idxs = np.arange(len(X))
+        for dim in range(X.shape[1]):
+            # np.interp holds the first and last valid value past the ends
+            X[~valid, dim] = np.interp(idxs[~valid], idxs[valid], X[valid, dim])
+    return X
+
+
+def mean_shift_scores(X: np.ndarray, window: int) -> np.ndarray:
+    """distance between the means of the `window` points before and after each index
+
+    Computed from prefix sums in linear time, near the ends the windows shrink to
+    what is available. Index 0 has nothing before it and scores 0.
+    """
+    n = len(X)
+    scores = np.zeros(n)
+    if n < 2:
+        return scores
+    prefix = np.zeros((n + 1, X.shape[1]))
+    np.cumsum(X, axis=0, out=prefix[1:])
+    t = np.arange(1, n)
+    left = np.minimum(window, t)
+    right = np.minimum(window, n - t)
+    mean_left = (prefix[t] - prefix[t - left]) / left[:, None]
+    mean_right = (prefix[t + right] - prefix[t]) / right[:, None]
+    scores[1:] = np.linalg.norm(mean_right - mean_left, axis=1)
+    return scores
+
+
+def robust_noise_scale(X: np.ndarray) -> float:
+    """standard deviation of the point noise, from the MAD of the first differences
+
+    Differences cancel the piecewise constant level, and the median ignores the
+    few large ones at the change points themselves.
+    """
+    if len(X) < 2:
+        return 0.0
+    diffs = np.diff(X, axis=0).ravel()
+    return float(1.4826 * np.median(np.abs(diffs)) / np.sqrt(2))
+
+
+def find_2d_data_bkps(
+    X: List[Tuple[int, int] | None],
+    window: int = IMPUTE_BKPS_WINDOW,
+    min_shift: float = IMPUTE_BKPS_MIN_SHIFT,
+    noise_z: float = IMPUTE_BKPS_NOISE_Z,
+) -> List[int]:
+    """change points of a piecewise constant 2d signal, where each new segment starts
+
+    A windowed mean shift detector: an index is a change point when the shift of
+    the mean between the windows around it is above the threshold and the largest
+    within a window on both sides. Linear in time and memory.
+
+    Change points are at least `window` points apart, so `window` is the minimum
+    segment length: a shorter segment does not get both of its change points and
+    is merged, in whole or in part, into a neighbour.
+    """
+    X = interpolate_missing(X)
+    n = len(X)
+    if n < 2:
+        return []
+    scores = mean_shift_scores(X, window)
+    # the noise of the difference of two means over `window` points
+    threshold = max(min_shift, noise_z * robust_noise_scale(X) * np.sqrt(2 / window))
+
+    # non maximum suppression over [t - window + 1, t + window - 1]
+    padded = np.pad(scores, window - 1)
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * window - 1).max(
+        axis=1
+    )
+    peaks = np.flatnonzero((scores > threshold) & (scores >= local_max))
+    # equal scores on a plateau, keep its first index only
+    if len(peaks):
+        peaks = peaks[np.r_[True, np.diff(peaks) >= window]]
+    return peaks.tolist()
+
+
+class StreamingBkpsDetector:
+    """`find_2d_data_bkps` fed one point at a time, in bounded memory.
+
+    Points are pushed with `update` while the detection is still running and only
+    the last two windows of prefix sums and scores are kept, so the memory does
+    not depend on the video length. Gaps of None are interpolated once the next
+    point arrives. The noise scale comes from the last `noise_history` first
+    differences instead of all of them, otherwise the change points are the
+    ones of `find_2d_data_bkps`.
+    """
 
-def find_2d_data_bkps(X: List[Tuple[int, int]]) -> List[int]:
-    X_clean = [point if point is not None else (np.nan, np.nan) for point in X]
-    X = np.array(X_clean, dtype=float)
-    X = pd.DataFrame(X).interpolate("linear").bfill().ffill().to_numpy()
-    X_std = StandardScaler().fit_transform(X)
-    algo = rpt.KernelCPD(kernel="rbf", jump=1).fit(X_std)
-    bkps = algo.predict(pen=10)
-    return bkps[:-1]
+    def __init__(
+        self,
+        window: int = IMPUTE_BKPS_WINDOW,
+        min_shift: float = IMPUTE_BKPS_MIN_SHIFT,
+        noise_z: float = IMPUTE_BKPS_NOISE_Z,
+        noise_history: int = IMPUTE_BKPS_NOISE_HISTORY,
+    ):
+        self.window = window
+        self.min_shift = min_shift
+        self.noise_z = noise_z
+        self.bkps: List[int] = []
+
+        self._num_points = 0
+        self._num_missing = 0
+        self._last_point = None
+        self._prev_point = None
+        # prefix sums of the last points, enough for both windows of a score, in
+        # plain floats as numpy is slower than python on two values
+        self._prefix = deque([(0.0, 0.0)], maxlen=2 * window + 1)
+        self._diffs = deque(maxlen=2 * noise_history)
+        self._noise = 0.0
+        self._noise_updated = None
+        # (index, score) pairs, enough for the suppression window of one index
+        self._scores = deque(maxlen=2 * window - 1)
+        self._next_score = 1
+        self._next_decision = 1
+        self._last_peak = None
+
+    def update(self, point: Tuple[int, int] | None):
+        if point is None:
+            self._num_missing += 1
+            return
+        point = (float(point[0]), float(point[1]))
+        if self._last_point is None:
+            # a leading gap holds the first value, as np.interp does
+            for _ in range(self._num_missing):
+                self._push(point)
+        else:
+            (x0, y0), (x1, y1) = self._last_point, point
+            steps = self._num_missing + 1
+            for i in range(1, steps):
+                self._push((x0 + (x1 - x0) * i / steps, y0 + (y1 - y0) * i / steps))
+        self._push(point)
+        self._last_point = point
+        self._num_missing = 0
+
+    def finalize(self) -> List[int]:
+        """flush the points still waiting for their right window, the change points"""
+        if self._last_point is not None:
+            for _ in range(self._num_missing):
+                self._push(self._last_point)
+        self._num_missing = 0
+        # the windows shrink at the end, as in `mean_shift_scores`
+        self._score_until(self._num_points - 1)
+        self._decide_until(self._num_points - 1)
+        return self.bkps
+
+    def _push(self, point: Tuple[float, float]):
+        x, y = point
+        if self._num_points:
+            self._diffs.append(abs(x - self._prev_point[0]))
+            self._diffs.append(abs(y - self._prev_point[1]))
+        self._prev_point = point
+        sum_x, sum_y = self._prefix[-1]
+        self._prefix.append((sum_x + x, sum_y + y))
+        self._num_points += 1
+        # the right window of this index has just been completed
+        self._score_until(self._num_points - self.window)
+
+    def _prefix_at(self, idx: int) -> Tuple[float, float]:
+        return self._prefix[len(self._prefix) - 1 - (self._num_points - idx)]
+
+    def _score_until(self, last: int):
+        while self._next_score <= last:
+            t = self._next_score
+            left = min(self.window, t)
+            right = min(self.window, self._num_points - t)
+            (lx, ly), (cx, cy), (rx, ry) = (
+                self._prefix_at(t - left),
+                self._prefix_at(t),
+                self._prefix_at(t + right),
+            )
+            score = math.hypot(
+                (rx - cx) / right - (cx - lx) / left,
+                (ry - cy) / right - (cy - ly) / left,
+            )
+            self._scores.append((t, score))
+            self._next_score += 1
+            self._decide_until(t - self.window + 1)
+
+    def _decide_until(self, last: int):
+        while self._next_decision <= last:
+            t = self._next_decision
+            first = self._scores[0][0]
+            score = self._scores[t - first][1]
+            neighbors = [s for idx, s in self._scores if abs(idx - t) < self.window]
+            # the median is refreshed once per window, not for every index
+            if self._noise_updated is None or t - self._noise_updated >= self.window:
+                self._noise = 1.4826 * float(np.median(self._diffs)) / np.sqrt(2)
+                self._noise_updated = t
+            threshold = max(
+                self.min_shift, self.noise_z * self._noise * math.sqrt(2 / self.window)
+            )
+            if score > threshold and score >= max(neighbors):
+                # equal scores on a plateau, keep its first index only
+                if self._last_peak is None or t - self._last_peak >= self.window:
+                    self.bkps.append(t)
+                self._last_peak = t
+            self._next_decision += 1
 
 
 def get_interval_average_bbox(
     bboxes: List[Tuple[int, int, int, int] | None], bkps: List[int]
 ) -> List[Tuple[int, int, int, int]]:
+    n = len(bboxes)
+    starts = np.asarray(bkps[:-1], dtype=np.int64)
+    if n == 0 or len(starts) == 0:
+        return [None] * len(starts)
+    values, valid = _bboxes_to_array(bboxes)
+    # np.add.reduceat needs in range starts, empty intervals are patched after
+    safe_starts = np.minimum(starts, n - 1)
+    sums = np.add.reduceat(np.where(valid[:, None], values, 0), safe_starts)
+    counts = np.add.reduceat(valid.astype(np.int64), safe_starts)
+    counts[np.asarray(bkps[1:]) <= starts] = 0
     average_bboxes = []
-    for left, right in zip(bkps[:-1], bkps[1:]):
-        bboxes_interval = bboxes[left:right]
-        valid_bboxes = [bbox for bbox in bboxes_interval if bbox is not None]
-        if len(valid_bboxes) > 0:
-            average_bbox = np.mean(valid_bboxes, axis=0)
-            average_bboxes.append(tuple(map(int, average_bbox)))
+    for interval_sum, count in zip(sums, counts):
+        if count > 0:
+            average_bboxes.append(tuple(map(int, interval_sum / count)))
         else:
             average_bboxes.append(None)
     return average_bboxes
 
 
 def find_idxs_interval(idxs: List[int], bkps: List[int]) -> List[int]:
-    def _find_idx_interval(_idx: int) -> int:
-        left = 0
-        right = len(bkps) - 2 
-
-        while left <= right:
-            mid = (left + right) // 2
-            if bkps[mid] <= _idx < bkps[mid + 1]:
-                return mid
-            elif _idx < bkps[mid]:
-                right = mid - 1
-            else:
-                left = mid + 1
-        return min(max(left, 0), len(bkps) - 2)
-
-    intervals = []
-    for idx in idxs:
-        interval_idx = _find_idx_interval(idx)
-        intervals.append(interval_idx)
-    return intervals
+    intervals = np.searchsorted(bkps, idxs, side="right") - 1
+    return np.clip(intervals, 0, max(len(bkps) - 2, 0)).tolist()
+
+
+def _bboxes_to_array(
+    bboxes: List[Tuple[int, int, int, int] | None],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """(n, 4) float array of the bboxes, zeros where None, and the mask of valid rows"""
+    valid = np.fromiter((bbox is not None for bbox in bboxes), bool, len(bboxes))
+    values = np.zeros((len(bboxes), 4))
+    if valid.any():
+        values[valid] = [bbox for bbox in bboxes if bbox is not None]
+    return values, valid
+
+
+def impute_missed_bboxes(
+    bboxes: List[Tuple[int, int, int, int] | None],
+    bkps: List[int] | None = None,
+) -> List[Tuple[int, int, int, int] | None]:
+    """fill the frames the detector missed with the average bbox of their interval
+
+    `bkps` are the change points of the bbox centers when already known, e.g. from
+    a `StreamingBkpsDetector` fed during detection.
+    """
+    bboxes = list(bboxes)
+    num_frames = len(bboxes)
+    values, valid = _bboxes_to_array(bboxes)
+    detect_missed = np.flatnonzero(~valid)
+    logger.debug(f"detect missed frames: {detect_missed.tolist()}")
+    if not len(detect_missed) or len(detect_missed) == num_frames:
+        return bboxes
+
+    # 1. find the bkps of the bbox centers
+    if bkps is None:
+        centers = (values[:, :2] + values[:, 2:]) / 2
+        bbox_centers = [
+            tuple(center) if is_valid else None
+            for center, is_valid in zip(centers.astype(int).tolist(), valid)
+        ]
+        bkps = find_2d_data_bkps(bbox_centers)
+    # add the start and end position, to form the complete interval boundaries
+    bkps_full = [0] + bkps + [num_frames]
+
+    # 2. calculate the average bbox of each interval
+    interval_bboxes = get_interval_average_bbox(bboxes, bkps_full)
+
+    # 3. find the interval index of each missed frame
+    missed_intervals = find_idxs_interval(detect_missed, bkps_full)
+
+    # 4. fill the missed frames with the average bbox of the corresponding interval
+    missed_bboxes = [interval_bboxes[interval_idx] for interval_idx in missed_intervals]
+    fallback = []
+    for missed_idx, missed_bbox in zip(detect_missed.tolist(), missed_bboxes):
+        if missed_bbox is not None:
+            bboxes[missed_idx] = missed_bbox
+        else:
+            fallback.append(missed_idx)
+    # if the interval has no valid bbox, use the previous and next frame to complete (fallback strategy)
+    for missed_idx in fallback:
+        before = max(missed_idx - 1, 0)
+        after = min(missed_idx + 1, num_frames - 1)
+        before_box = bboxes[before]
+        after_box = bboxes[after]
+        if before_box:
+            bboxes[missed_idx] = before_box
+        elif after_box:
+            bboxes[missed_idx] = after_box
+    logger.debug(f"filled {len(detect_missed)} missed frames over {len(bkps)} bkps")
+    return bboxes
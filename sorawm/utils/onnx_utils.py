@@ -0,0 +1,115 @@
+import ast
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from sorawm.configs import DETECT_CONF, DETECT_IMGSZ
+from sorawm.utils.detection_utils import letterbox
+
+
+def export_yolo_onnx(weights_path: Path, onnx_path: Path) -> Path:
+    """export the yolo weights to onnx, again only when the weights are newer"""
+    if (
+        onnx_path.exists()
+        and onnx_path.stat().st_mtime >= Path(weights_path).stat().st_mtime
+    ):
+        return onnx_path
+    # the export is the only part of the onnx backend that needs ultralytics
+    from ultralytics import YOLO
+
+    logger.info(f"Exporting {weights_path} to onnx, once.")
+    # ultralytics writes the export next to the weights, which is `onnx_path`
+    # itself, so export a copy in a private directory and rename the result in
+    # place, a concurrent reader never sees a partial file
+    with tempfile.TemporaryDirectory(dir=onnx_path.parent) as tmp_dir:
+        tmp_weights = Path(tmp_dir) / Path(weights_path).name
+        shutil.copy2(weights_path, tmp_weights)
+        # dynamic axes, the batch size and the roi crop sizes vary
+        exported = YOLO(tmp_weights).export(format="onnx", dynamic=True, device="cpu")
+        os.replace(exported, onnx_path)
+    logger.success(f"✓ Onnx weights exported: {onnx_path}")
+    return onnx_path
+
+
+class OnnxYolo:
+    """yolo detection model exported to onnx, run with onnxruntime on the cpu
+
+    The pre processing follows the ultralytics predictor, a letterbox padded to
+    the stride. Only the top box of a frame is used, so the post processing is
+    the highest confidence anchor above `conf` instead of a full nms, in numpy.
+    """
+
+    def __init__(
+        self,
+        onnx_path: Path,
+        conf: float = DETECT_CONF,
+        num_threads: int | None = None,
+    ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            str(onnx_path), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.conf = conf
+
+        # ultralytics records the export settings in the model metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        imgsz = ast.literal_eval(metadata.get("imgsz", str(DETECT_IMGSZ)))
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        self.stride = int(metadata.get("stride", 32))
+
+    def predict(
+        self, frames: list[np.ndarray], imgsz: tuple[int, int] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Run one forward over same shaped bgr `frames`.
+
+        Returns the indexes of the frames with a detection and their top box as
+        rows of (x1, y1, x2, y2, confidence, class), in frame pixels.
+        """
+        shape = imgsz if imgsz is not None else (self.imgsz, self.imgsz)
+        batch = []
+        for frame in frames:
+            image, ratio, (left, top) = letterbox(frame, shape, self.stride)
+            batch.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        blob = np.ascontiguousarray(
+            np.stack(batch).transpose(0, 3, 1, 2), dtype=np.float32
+        )
+        blob /= 255.0
+        # (batch, 4 + classes, anchors) with xywh boxes in input pixels
+        outputs = self.session.run(None, {self.input_name: blob})[0]
+
+        height, width = frames[0].shape[:2]
+        # the best class of every anchor, then the best anchor of every frame
+        class_scores = outputs[:, 4:, :]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores.max(axis=1)
+        best = scores.argmax(axis=1)
+        frame_idxs = np.arange(len(outputs))
+        best_scores = scores[frame_idxs, best]
+        hit_idxs = np.flatnonzero(best_scores > self.conf)
+        if not len(hit_idxs):
+            return np.empty(0, dtype=int), np.empty((0, 6), dtype=np.float32)
+
+        x, y, w, h = outputs[hit_idxs, :4, best[hit_idxs]].T
+        boxes = np.stack([x - w / 2, y - h / 2, x + w / 2, y + h / 2], axis=1)
+        # undo the letterbox, all frames share its ratio and padding
+        boxes[:, [0, 2]] = np.clip((boxes[:, [0, 2]] - left) / ratio, 0, width)
+        boxes[:, [1, 3]] = np.clip((boxes[:, [1, 3]] - top) / ratio, 0, height)
+        top_boxes = np.concatenate(
+            [
+                boxes,
+                best_scores[hit_idxs, None],
+                classes[hit_idxs, best[hit_idxs], None],
+            ],
+            axis=1,
+        )
+        return hit_idxs, top_boxes.astype(np.float32)
@@ -0,0 +1,111 @@
+import threading
+from queue import Full, Queue
+from typing import Any, Callable, Iterable, Iterator
+
+_SENTINEL = object()
+# how often a blocked thread wakes up to check whether the other side stopped
+_POLL_INTERVAL = 0.1
+
+
+def prefetch(iterable: Iterable[Any], maxsize: int) -> Iterator[Any]:
+    """Iterate `iterable` in a background thread, at most `maxsize` items ahead.
+
+    The producer blocks once the queue is full, exceptions raised while
+    producing are re-raised in the consumer, and closing the returned generator
+    stops the producer.
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    error = []
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    break
+        except BaseException as e:
+            error.append(e)
+        finally:
+            # closes the underlying generator (e.g. the ffmpeg process) in this thread
+            close = getattr(iterable, "close", None)
+            if close is not None and stop.is_set():
+                close()
+            _put(_SENTINEL)
+
+    thread = threading.Thread(target=_produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _SENTINEL:
+                break
+            yield item
+        if error:
+            raise error[0]
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ThreadedWriter:
+    """Run `write_fn` on a background thread fed through a bounded queue.
+
+    `write` blocks once `maxsize` items are pending, which applies back-pressure
+    to the producer instead of buffering without limit. Errors raised by
+    `write_fn` are re-raised by the next `write` or by `close`.
+    """
+
+    def __init__(self, write_fn: Callable[[Any], None], maxsize: int):
+        self.write_fn = write_fn
+        self.queue = Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._consume, name="writer", daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is _SENTINEL:
+                return
+            if self.error is not None:
+                # drain the queue so the producer never blocks on a dead writer
+                continue
+            try:
+                self.write_fn(item)
+            except BaseException as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, item: Any):
+        self._raise_error()
+        while True:
+            try:
+                self.queue.put(item, timeout=_POLL_INTERVAL)
+                return
+            except Full:
+                self._raise_error()
+
+    def close(self, raise_error: bool = True):
+        self.queue.put(_SENTINEL)
+        self.thread.join()
+        if raise_error:
+            self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # do not hide the exception that is already propagating
+        self.close(raise_error=exc_type is None)
@@ -1,13 +1,260 @@
+import re
+import threading
 from pathlib import Path
+from typing import Sequence
 
 import ffmpeg
 import numpy as np
+from loguru import logger
+
+# audio codecs each container can take as is, None means any codec
+AUDIO_COPY_CODECS = {
+    ".mp4": {"aac", "mp3", "alac", "ac3", "eac3", "opus", "flac"},
+    ".m4v": {"aac", "mp3", "alac", "ac3", "eac3"},
+    ".mov": {"aac", "mp3", "alac", "ac3", "eac3", "pcm_s16le", "pcm_s24le"},
+    ".avi": {"mp3", "ac3", "pcm_s16le"},
+    ".mkv": None,
+}
+
+
+# h264 nal unit types of the slices of a non IDR and of an IDR picture
+H264_NAL_SLICE = 1
+H264_NAL_IDR_SLICE = 5
+
+# the libx264 profile writing the h264 profile ffprobe reports
+X264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+}
+
+
+def can_copy_audio(audio_codec: str, output_path: Path) -> bool:
+    """whether the audio stream can be stream copied into the output container"""
+    suffix = output_path.suffix.lower()
+    if suffix not in AUDIO_COPY_CODECS:
+        return False
+    codecs = AUDIO_COPY_CODECS[suffix]
+    return codecs is None or audio_codec in codecs
+
+
+def sniff_video_container(head: bytes) -> str | None:
+    """container of a video file from its first bytes, None when not a known one"""
+    # iso bmff files (mp4, mov, m4v) start with a box of one of these types
+    if head[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip"):
+        return "mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "matroska"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "avi"
+    if head[:1] == b"\x47" and head[188:189] in (b"", b"\x47"):
+        return "mpegts"
+    return None
+
+
+def read_exactly(stream, buffer) -> bool:
+    """fill the buffer from the stream, False when the stream ends first"""
+    view = memoryview(buffer).cast("B")
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            return False
+        filled += n
+    return True
+
+
+class FrameBufferPool:
+    """Ring of reusable frame buffers.
+
+    Buffers are allocated on first use and kept for reuse once released, up to
+    `ring_size` of them, so a steady stream of frames stops allocating. The pool
+    never blocks: when every buffer is still in use a new one is allocated, the
+    bounded queues of the pipeline are what limits the frames in flight.
+    """
+
+    def __init__(self, ring_size: int, shape: tuple[int, ...]):
+        self.ring_size = ring_size
+        self.shape = shape
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> np.ndarray:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return np.empty(self.shape, dtype=np.uint8)
+
+    def release(self, buffer: np.ndarray):
+        with self._lock:
+            if len(self._free) < self.ring_size:
+                self._free.append(buffer)
+
+
+def h264_slice_nal_type(data: bytes) -> int | None:
+    """nal unit type of the first slice of an h264 access unit, None without one
+
+    Takes annex b data (start codes) or the length prefixed nal units of mp4.
+    """
+    if data.startswith((b"\x00\x00\x01", b"\x00\x00\x00\x01")):
+        units = re.split(b"\x00\x00\x01", data)[1:]
+    else:
+        # 4 byte lengths, the size nearly every muxer writes
+        units, pos = [], 0
+        while pos + 4 <= len(data):
+            length = int.from_bytes(data[pos : pos + 4], "big")
+            units.append(data[pos + 4 : pos + 4 + length])
+            pos += 4 + length
+    for unit in units:
+        if unit and unit[0] & 0x1F in (H264_NAL_SLICE, H264_NAL_IDR_SLICE):
+            return unit[0] & 0x1F
+    return None
+
+
+def get_keyframe_indices(
+    video_path: Path, fps: float, idr_only: bool = False
+) -> list[int]:
+    """frame indices of the keyframes, read from the packet flags without decoding
+
+    With `idr_only`, only the h264 keyframes that are IDR pictures. The keyframe
+    flag also marks the other I pictures of open GOPs, the frames after one can
+    still reference the frames before it, so a stream can not be cut there. The
+    first frame is always included.
+    """
+    probe = ffmpeg.probe(
+        str(video_path),
+        select_streams="v:0",
+        show_entries="packet=pts_time,flags,pos,size",
+    )
+    packets = [p for p in probe.get("packets", []) if p.get("pts_time") is not None]
+    if not packets:
+        return [0]
+    start_time = min(float(p["pts_time"]) for p in packets)
+    key_packets = [p for p in packets if "K" in p.get("flags", "")]
+    if idr_only:
+        with open(video_path, "rb") as f:
+
+            def _is_idr(packet: dict) -> bool:
+                if packet.get("pos") in (None, "N/A"):
+                    return False
+                f.seek(int(packet["pos"]))
+                data = f.read(int(packet["size"]))
+                return h264_slice_nal_type(data) == H264_NAL_IDR_SLICE
+
+            idr_packets = [p for p in key_packets if _is_idr(p)]
+        if len(idr_packets) < len(key_packets):
+            logger.warning(
+                f"{len(key_packets) - len(idr_packets)} of {len(key_packets)} "
+                f"keyframes of {Path(video_path).name} are not IDR pictures (open "
+                "GOPs), the video is only cut at the IDR ones"
+            )
+        key_packets = idr_packets
+    keyframes = {round((float(p["pts_time"]) - start_time) * fps) for p in key_packets}
+    return sorted(keyframes | {0})
+
+
+def split_at_keyframes(
+    keyframes: Sequence[int], total_frames: int, num_chunks: int
+) -> list[tuple[int, int | None]]:
+    """split [0, total_frames) into about `num_chunks` even [start, end) chunks
+
+    Every chunk starts at a keyframe. The last chunk ends at None, it runs to the
+    end of the video, as the probed frame count can be an estimate.
+    """
+    keyframes = np.asarray(sorted(k for k in keyframes if 0 < k < total_frames))
+    targets = np.arange(1, max(num_chunks, 1)) * total_frames / max(num_chunks, 1)
+    if len(keyframes) and len(targets):
+        nearest = np.abs(keyframes[None, :] - targets[:, None]).argmin(axis=1)
+        starts = [0] + sorted({int(k) for k in keyframes[nearest]})
+    else:
+        starts = [0]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def copy_video_segment(
+    video_path: Path, output_path: Path, start_frame: int, end_frame: int, fps: float
+):
+    """stream copy the video frames [start_frame, end_frame) into an mpegts segment
+
+    `start_frame` has to be an IDR keyframe and `end_frame` the next one after the
+    copied GOPs (or the end of the video), otherwise the segment does not decode,
+    see `get_keyframe_indices`.
+    """
+    (
+        # seeking half a frame past the keyframe still lands on it, whatever the
+        # rounding of its timestamp
+        ffmpeg.input(str(video_path), ss=(start_frame + 0.5) / fps)
+        .output(
+            str(output_path),
+            vcodec="copy",
+            an=None,
+            vframes=end_frame - start_frame,
+            format="mpegts",
+            **{"bsf:v": "h264_mp4toannexb"},
+        )
+        .overwrite_output()
+        .global_args("-loglevel", "error")
+        .run()
+    )
+
+
+def concat_video_segments(
+    segment_paths: Sequence[Path],
+    output_path: Path,
+    audio_source: Path | None = None,
+    audio_codec: str | None = None,
+):
+    """stream copy the segments into one video, with the audio of `audio_source`"""
+    list_path = output_path.with_name(f"{output_path.stem}_segments.txt")
+    list_path.write_text(
+        "".join(f"file '{Path(p).resolve().as_posix()}'\n" for p in segment_paths)
+    )
+    try:
+        output_streams = [ffmpeg.input(str(list_path), format="concat", safe=0).video]
+        output_options = {"vcodec": "copy"}
+        if audio_source is not None and audio_codec:
+            output_streams.append(ffmpeg.input(str(audio_source)).audio)
+            output_options["acodec"] = (
+                "copy" if can_copy_audio(audio_codec, output_path) else "aac"
+            )
+        (
+            ffmpeg.output(*output_streams, str(output_path), **output_options)
+            .overwrite_output()
+            .global_args("-loglevel", "error")
+            .run()
+        )
+    finally:
+        list_path.unlink(missing_ok=True)
 
 
 class VideoLoader:
-    def __init__(self, video_path: Path):
+    def __init__(
+        self,
+        video_path: Path,
+        ring_size: int | None = None,
+        start_frame: int = 0,
+        end_frame: int | None = None,
+    ):
+        """
+        Args:
+            video_path:
+            ring_size: when set, frames are read into a pool of `ring_size` reusable
+                buffers, and consumers give them back with `release` once done.
+            start_frame, end_frame: only decode the frames [start_frame, end_frame).
+        """
         self.video_path = video_path
+        self.start_frame = start_frame
+        self.end_frame = end_frame
         self.get_video_info()
+        if end_frame is not None:
+            self.total_frames = min(self.total_frames, end_frame)
+        self.total_frames = max(self.total_frames - start_frame, 0)
+        self.buffer_pool = (
+            FrameBufferPool(ring_size, (self.height, self.width, 3))
+            if ring_size
+            else None
+        )
 
     def get_video_info(self):
         probe = ffmpeg.probe(self.video_path)
@@ -28,26 +275,61 @@ class VideoLoader:
         original_bitrate = video_info.get("bit_rate", None)
         self.original_bitrate = original_bitrate
 
+        audio_info = next(
+            (s for s in probe["streams"] if s["codec_type"] == "audio"), None
+        )
+        self.audio_codec = audio_info["codec_name"] if audio_info else None
+        self.codec_name = video_info.get("codec_name")
+        self.pix_fmt = video_info.get("pix_fmt")
+        self.profile = video_info.get("profile")
+        # ffprobe reports the level times ten, e.g. 41 for 4.1
+        self.level = video_info.get("level")
+
     def __len__(self):
         return self.total_frames
 
+    def release(self, frame: np.ndarray):
+        """give a yielded frame back to the buffer pool, a no-op without a pool"""
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(frame)
+
+    def _read_frame(self, stream) -> np.ndarray | None:
+        if self.buffer_pool is not None:
+            frame = self.buffer_pool.acquire()
+            if not read_exactly(stream, frame):
+                self.buffer_pool.release(frame)
+                return None
+            return frame
+
+        # a bytearray keeps the frame writable, so it can be edited in place
+        buffer = bytearray(self.width * self.height * 3)
+        if not read_exactly(stream, buffer):
+            return None
+        return np.frombuffer(buffer, np.uint8).reshape([self.height, self.width, 3])
+
     def __iter__(self):
+        input_options = {}
+        output_options = {}
+        if self.start_frame:
+            # half a frame early, so the rounding of the timestamps can not drop
+            # the first frame of the range, and no frame rate conversion, which
+            # would duplicate that first frame to fill the half frame gap
+            input_options["ss"] = (self.start_frame - 0.5) / self.fps
+            output_options["vsync"] = "passthrough"
+        if self.end_frame is not None:
+            output_options["vframes"] = self.end_frame - self.start_frame
         process_in = (
-            ffmpeg.input(self.video_path)
-            .output("pipe:", format="rawvideo", pix_fmt="bgr24")
+            ffmpeg.input(self.video_path, **input_options)
+            .output("pipe:", format="rawvideo", pix_fmt="bgr24", **output_options)
             .global_args("-loglevel", "error")
             .run_async(pipe_stdout=True)
         )
 
         try:
             while True:
-                in_bytes = process_in.stdout.read(self.width * self.height * 3)
-                if not in_bytes:
+                frame = self._read_frame(process_in.stdout)
+                if frame is None:
                     break
-
-                frame = np.frombuffer(in_bytes, np.uint8).reshape(
-                    [self.height, self.width, 3]
-                )
                 yield frame
         finally:
             # 确保进程被清理
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from pathlib import Path
 
 import cv2
@@ -5,29 +6,145 @@ import numpy as np
 import torch
 from loguru import logger
 
-from sorawm.configs import DEFAULT_WATERMARK_REMOVE_MODEL
+from sorawm.configs import (
+    CLEAN_BACKEND,
+    CLEAN_CROP_MARGIN,
+    CLEAN_INTER_OP_THREADS,
+    CLEAN_INTRA_OP_THREADS,
+    DEFAULT_WATERMARK_REMOVE_MODEL,
+    TEMPORAL_KEYFRAME_INTERVAL,
+    TEMPORAL_RESIDUAL_THRESHOLD,
+)
 from sorawm.iopaint.const import DEFAULT_MODEL_DIR
 from sorawm.iopaint.download import cli_download_model, scan_models
+from sorawm.iopaint.model import models
 from sorawm.iopaint.model_manager import ModelManager
 from sorawm.iopaint.schema import InpaintRequest
+from sorawm.utils.cache_utils import PatchCache, context_fingerprint
 from sorawm.utils.devices_utils import get_device
 
 # This codebase is from https://github.com/Sanster/IOPaint#, thanks for their amazing work!
 
 
+def snap_window(lo: int, hi: int, mod: int, limit: int) -> tuple[int, int]:
+    """grow [lo, hi) to a multiple of `mod` and shift it inside [0, limit)"""
+    length = hi - lo
+    target = -(-length // mod) * mod
+    if target > limit:
+        target = max((limit // mod) * mod, min(length, limit))
+    grow = target - length
+    lo -= grow // 2
+    hi = lo + target
+    if lo < 0:
+        lo, hi = 0, target
+    if hi > limit:
+        lo, hi = limit - target, limit
+    return max(lo, 0), min(hi, limit)
+
+
+def paste_patch(image: np.array, patch: np.array, offset: tuple[int, int]):
+    """write the patch into the image in place, at (x, y) offset"""
+    x, y = offset
+    image[y : y + patch.shape[0], x : x + patch.shape[1]] = patch
+
+
+def propagation_maps(
+    prev_gray: np.array, gray: np.array, hole_mask: np.array
+) -> tuple[np.array, np.array, float]:
+    """remap maps that pull the previous crop onto the current one, and their residual
+
+    The dense flow inside the hole follows the watermark, not the background, so
+    it is replaced by the median flow of a band around the hole. The residual is
+    the mean absolute gray difference between the warped previous crop and the
+    current one outside the hole.
+    """
+    flow = cv2.calcOpticalFlowFarneback(gray, prev_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    hole = hole_mask > 0
+    band = cv2.dilate(hole_mask, np.ones((15, 15), np.uint8)) > 0
+    band &= ~hole
+    flow[hole] = np.median(flow[band], axis=0) if band.any() else 0
+    height, width = gray.shape
+    grid_x, grid_y = np.meshgrid(
+        np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32)
+    )
+    map_x = grid_x + flow[..., 0]
+    map_y = grid_y + flow[..., 1]
+    warped = cv2.remap(
+        prev_gray, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+    )
+    residual = float(
+        np.abs(warped.astype(np.float32) - gray.astype(np.float32))[~hole].mean()
+    )
+    return map_x, map_y, residual
+
+
 class WaterMarkCleaner:
-    def __init__(self):
+    def __init__(
+        self,
+        crop_margin: int = CLEAN_CROP_MARGIN,
+        patch_cache_size: int = 0,
+        temporal: bool = False,
+        temporal_keyframe_interval: int = TEMPORAL_KEYFRAME_INTERVAL,
+        temporal_residual_threshold: float = TEMPORAL_RESIDUAL_THRESHOLD,
+        backend: str = CLEAN_BACKEND,
+        intra_op_threads: int = CLEAN_INTRA_OP_THREADS,
+        inter_op_threads: int = CLEAN_INTER_OP_THREADS,
+    ):
+        """
+        Args:
+            crop_margin: context kept around the watermark bbox by `clean_bbox`.
+            patch_cache_size: when set, up to this many inpainted patches are kept
+                and reused for frames with the same bbox and a matching context,
+                see `PatchCache`.
+            temporal: video mode of `clean_patch_batch`, the images are consecutive
+                frames and the model only inpaints keyframes of each bbox segment,
+                the frames in between get the previous fill warped with optical
+                flow. Call `reset_temporal` before every new video.
+            temporal_keyframe_interval: frames after which the model inpaints again.
+            temporal_residual_threshold: mean gray difference of the warped
+                context above which the flow is not trusted and the model inpaints.
+            backend: inference backend of the model on the cpu, see
+                `load_erase_model`.
+            intra_op_threads: intra op threads of the backend, 0 for the default.
+                Set on the process wide torch pool, see `set_torch_threads`.
+            inter_op_threads: inter op threads of the backend, 0 for the default.
+                Set on the process wide torch pool, see `set_torch_threads`.
+        """
         self.model = DEFAULT_WATERMARK_REMOVE_MODEL
         self.device = get_device()
-
+        self.crop_margin = crop_margin
+        self.patch_cache = PatchCache(patch_cache_size) if patch_cache_size else None
+        self.temporal = temporal
+        self.temporal_keyframe_interval = temporal_keyframe_interval
+        self.temporal_residual_threshold = temporal_residual_threshold
+        self.temporal_stats = {"inpainted": 0, "propagated": 0}
+        self.reset_temporal()
+
+        # refused before the model is downloaded and loaded
+        erase_backends = models[self.model].erase_backends
+        if backend not in erase_backends:
+            raise ValueError(
+                f"The {self.model} model can not run on the {backend} clean "
+                f"backend, use one of {erase_backends}"
+            )
         scanned_models = scan_models()
         if self.model not in [it.name for it in scanned_models]:
             logger.info(
                 f"{self.model} not found in {DEFAULT_MODEL_DIR}, try to downloading"
             )
             cli_download_model(self.model)
-        self.model_manager = ModelManager(name=self.model, device=self.device)
+        self.backend = backend
+        self.model_manager = ModelManager(
+            name=self.model,
+            device=self.device,
+            erase_backend=backend,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+        )
         self.inpaint_request = InpaintRequest()
+        # only the masked area of the result is used by the patch api, so the
+        # blend with the unmasked area can be skipped
+        self.patch_request = InpaintRequest(sd_keep_unmasked_area=False)
 
     def clean(self, input_image: np.array, watermark_mask: np.array) -> np.array:
         inpaint_result = self.model_manager(
@@ -36,6 +153,196 @@ class WaterMarkCleaner:
         inpaint_result = cv2.cvtColor(inpaint_result, cv2.COLOR_BGR2RGB)
         return inpaint_result
 
+    def crop_window(
+        self, bbox: tuple[int, int, int, int], image_shape: tuple[int, ...]
+    ) -> tuple[int, int, int, int]:
+        """Context window around the bbox, sized to a multiple of the model pad_mod."""
+        height, width = image_shape[:2]
+        x1, y1, x2, y2 = bbox
+        pad_mod = self.model_manager.model.pad_mod
+        wx1, wx2 = snap_window(
+            x1 - self.crop_margin, x2 + self.crop_margin, pad_mod, width
+        )
+        wy1, wy2 = snap_window(
+            y1 - self.crop_margin, y2 + self.crop_margin, pad_mod, height
+        )
+        return wx1, wy1, wx2, wy2
+
+    def _crop_with_mask(
+        self, input_image: np.array, bbox: tuple[int, int, int, int]
+    ) -> tuple[
+        np.array, np.array, tuple[int, int, int, int], tuple[int, int, int, int]
+    ]:
+        """crop the context window, its mask and the bbox clipped to the window"""
+        window = self.crop_window(bbox, input_image.shape)
+        wx1, wy1, wx2, wy2 = window
+        x1, y1, x2, y2 = bbox
+        region = (
+            min(max(x1, wx1), wx2),
+            min(max(y1, wy1), wy2),
+            min(max(x2, wx1), wx2),
+            min(max(y2, wy1), wy2),
+        )
+        crop_image = input_image[wy1:wy2, wx1:wx2]
+        crop_mask = np.zeros(crop_image.shape[:2], dtype=np.uint8)
+        crop_mask[
+            region[1] - wy1 : region[3] - wy1, region[0] - wx1 : region[2] - wx1
+        ] = 255
+        return crop_image, crop_mask, window, region
+
+    def clean_patch(
+        self, input_image: np.array, bbox: tuple[int, int, int, int]
+    ) -> tuple[np.array, tuple[int, int]]:
+        """Inpaint a window around the bbox and return only the bbox patch and its (x, y) offset."""
+        return self.clean_patch_batch([input_image], [bbox])[0]
+
+    def clean_patch_batch(
+        self,
+        input_images: list[np.array],
+        bboxes: list[tuple[int, int, int, int] | None],
+    ) -> list[tuple[np.array, tuple[int, int]] | None]:
+        """Batched `clean_patch`, crops with the same shape share one model forward.
+
+        The entry of an image whose bbox is None is None.
+        """
+        if self.temporal:
+            return self._clean_patch_temporal(input_images, bboxes)
+        crops = {
+            idx: self._crop_with_mask(input_image, bbox)
+            for idx, (input_image, bbox) in enumerate(zip(input_images, bboxes))
+            if bbox is not None
+        }
+        return self._inpaint_crops(crops, len(input_images))
+
+    def _inpaint_crops(
+        self, crops: dict[int, tuple], num_images: int
+    ) -> list[tuple[np.array, tuple[int, int]] | None]:
+        """bbox patches of the `_crop_with_mask` results, keyed by image index"""
+        patches = [None] * num_images
+        groups = defaultdict(list)
+        for idx, (crop_image, crop_mask, window, region) in crops.items():
+            fingerprint = None
+            if self.patch_cache is not None:
+                fingerprint = context_fingerprint(crop_image, crop_mask)
+                patch = self.patch_cache.get((window, region), fingerprint)
+                if patch is not None:
+                    patches[idx] = (patch, region[:2])
+                    continue
+            groups[crop_image.shape].append(
+                (idx, crop_image, crop_mask, window, region, fingerprint)
+            )
+
+        for group in groups.values():
+            inpaint_results = self.model_manager.forward_batch(
+                [it[1] for it in group], [it[2] for it in group], self.patch_request
+            )
+            for (idx, _, _, window, region, fingerprint), inpaint_result in zip(
+                group, inpaint_results
+            ):
+                wx1, wy1 = window[:2]
+                x1, y1, x2, y2 = region
+                patch = cv2.cvtColor(
+                    inpaint_result[y1 - wy1 : y2 - wy1, x1 - wx1 : x2 - wx1],
+                    cv2.COLOR_BGR2RGB,
+                )
+                patches[idx] = (patch, (x1, y1))
+                if self.patch_cache is not None:
+                    self.patch_cache.put((window, region), fingerprint, patch)
+        return patches
+
+    def reset_temporal(self):
+        """forget the previous frame of the temporal mode"""
+        self._prev_gray = None
+        self._prev_window = None
+        self._prev_region = None
+        self._prev_clean_crop = None
+        self._frames_since_inpaint = 0
+
+    def _clean_patch_temporal(
+        self,
+        input_images: list[np.array],
+        bboxes: list[tuple[int, int, int, int] | None],
+    ) -> list[tuple[np.array, tuple[int, int]] | None]:
+        """`clean_patch_batch` of the temporal mode, on consecutive frames"""
+        # 1. which frames the model inpaints only depends on the input frames, so
+        # all keyframes of the batch still share the batched forward
+        plan = []
+        for idx, (input_image, bbox) in enumerate(zip(input_images, bboxes)):
+            if bbox is None:
+                self._prev_gray = None
+                continue
+            crop_image, crop_mask, window, region = self._crop_with_mask(
+                input_image, bbox
+            )
+            gray = cv2.cvtColor(crop_image, cv2.COLOR_BGR2GRAY)
+            maps = None
+            if (
+                self._prev_gray is not None
+                and (window, region) == (self._prev_window, self._prev_region)
+                and self._frames_since_inpaint < self.temporal_keyframe_interval
+            ):
+                map_x, map_y, residual = propagation_maps(
+                    self._prev_gray, gray, crop_mask
+                )
+                if residual <= self.temporal_residual_threshold:
+                    maps = (map_x, map_y)
+            self._frames_since_inpaint = (
+                0 if maps is None else (self._frames_since_inpaint + 1)
+            )
+            self._prev_gray = gray
+            self._prev_window, self._prev_region = window, region
+            plan.append((idx, (crop_image, crop_mask, window, region), maps))
+
+        patches = self._inpaint_crops(
+            {idx: crop for idx, crop, maps in plan if maps is None},
+            len(input_images),
+        )
+
+        # 2. the fills are carried forward in frame order
+        for idx, (crop_image, _, window, region), maps in plan:
+            wx1, wy1 = window[:2]
+            x1, y1, x2, y2 = region
+            if maps is None:
+                self.temporal_stats["inpainted"] += 1
+            else:
+                warped = cv2.remap(
+                    self._prev_clean_crop,
+                    *maps,
+                    cv2.INTER_LINEAR,
+                    borderMode=cv2.BORDER_REPLICATE,
+                )
+                patches[idx] = (
+                    warped[y1 - wy1 : y2 - wy1, x1 - wx1 : x2 - wx1],
+                    (x1, y1),
+                )
+                self.temporal_stats["propagated"] += 1
+            clean_crop = crop_image.copy()
+            paste_patch(clean_crop, patches[idx][0], (x1 - wx1, y1 - wy1))
+            self._prev_clean_crop = clean_crop
+        return patches
+
+    def clean_bbox(
+        self, input_image: np.array, bbox: tuple[int, int, int, int]
+    ) -> np.array:
+        """Inpaint only a window around the bbox, the cost does not depend on the frame size."""
+        cleaned_image = input_image.copy()
+        paste_patch(cleaned_image, *self.clean_patch(input_image, bbox))
+        return cleaned_image
+
+    def clean_batch(
+        self,
+        input_images: list[np.array],
+        bboxes: list[tuple[int, int, int, int] | None],
+    ) -> list[np.array]:
+        """Batched `clean_bbox`, images whose bbox is None are returned unchanged."""
+        cleaned_images = list(input_images)
+        for idx, patch in enumerate(self.clean_patch_batch(input_images, bboxes)):
+            if patch is None:
+                continue
+            cleaned_images[idx] = input_images[idx].copy()
+            paste_patch(cleaned_images[idx], *patch)
+        return cleaned_images
+
 
 if __name__ == "__main__":
     from pathlib import Path
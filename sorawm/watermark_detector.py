@@ -1,57 +1,210 @@
 from pathlib import Path
 
 import numpy as np
+import torch
 from loguru import logger
-from ultralytics import YOLO
 
-from sorawm.configs import WATER_MARK_DETECT_YOLO_WEIGHTS
+from sorawm.configs import (
+    DETECT_BACKEND,
+    DETECT_BATCH_SIZE,
+    DETECT_IMGSZ,
+    DETECT_MAX_LEARNED_ROIS,
+    DETECT_ROI_BORDER_MARGIN,
+    DETECT_ROI_EXPAND,
+    DETECT_ROIS,
+    WATER_MARK_DETECT_ONNX_WEIGHTS,
+    WATER_MARK_DETECT_YOLO_WEIGHTS,
+)
+from sorawm.utils.detection_utils import (
+    bbox_inside,
+    expand_bbox,
+    merge_rois,
+    roi_inference_size,
+    roi_to_pixels,
+    touches_inner_border,
+)
 from sorawm.utils.download_utils import download_detector_weights
 from sorawm.utils.devices_utils import get_device
+from sorawm.utils.onnx_utils import OnnxYolo, export_yolo_onnx
 from sorawm.utils.video_utils import VideoLoader
 
 # based on the sora tempalte to detect the whole, and then got the icon part area.
 
 
 class SoraWaterMarkDetector:
-    def __init__(self):
+    def __init__(
+        self,
+        use_roi: bool = False,
+        rois: list[tuple[float, float, float, float]] | None = None,
+        backend: str = DETECT_BACKEND,
+    ):
         download_detector_weights()
         logger.debug(f"Begin to load yolo water mark detet model.")
-        self.model = YOLO(WATER_MARK_DETECT_YOLO_WEIGHTS)
-        self.model.to(str(get_device()))
+        self.backend = backend
+        if backend == "onnx":
+            # no ultralytics and torch inference, the onnx export runs on the cpu
+            # with as many threads as torch was given
+            self.model = OnnxYolo(
+                export_yolo_onnx(
+                    WATER_MARK_DETECT_YOLO_WEIGHTS, WATER_MARK_DETECT_ONNX_WEIGHTS
+                ),
+                num_threads=torch.get_num_threads(),
+            )
+            self.imgsz = self.model.imgsz
+        elif backend == "torch":
+            from ultralytics import YOLO
+
+            self.model = YOLO(WATER_MARK_DETECT_YOLO_WEIGHTS)
+            self.model.to(str(get_device()))
+            self.model.eval()
+            imgsz = self.model.overrides.get("imgsz", DETECT_IMGSZ)
+            self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        else:
+            raise ValueError(f"Unknown detector backend: {backend}")
         logger.debug(f"Yolo water mark detet model loaded.")
 
-        self.model.eval()
+        # roi mode: run yolo on crops of the regions the watermark can appear in,
+        # learned regions around previous hits first, then the configured ones,
+        # and the full frame only for frames every roi missed.
+        self.use_roi = use_roi
+        self.rois = rois if rois is not None else DETECT_ROIS
+        self.learned_rois = []
 
-    def detect(self, input_image: np.array):
-        # Run YOLO inference
-        results = self.model(input_image, verbose=False)
-        # Extract predictions from the first (and only) result
-        result = results[0]
+    def reset_learned_rois(self):
+        """learned rois are in pixels of one video, forget them before the next one"""
+        self.learned_rois = []
 
-        # Check if any detections were made
-        if len(result.boxes) == 0:
+    def detect(self, input_image: np.array):
+        batch_result = self.detect_batch([input_image], batch_size=1)
+        if not batch_result["detected"][0]:
             return {"detected": False, "bbox": None, "confidence": None, "center": None}
 
-        # Get the first detection (highest confidence)
-        box = result.boxes[0]
-
-        # Extract bounding box coordinates (xyxy format)
-        # Convert tensor to numpy, then to python float, finally to int
-        xyxy = box.xyxy[0].cpu().numpy()
-        x1, y1, x2, y2 = float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])
-        # Extract confidence score
-        confidence = float(box.conf[0].cpu().numpy())
-        # Calculate center point
-        center_x = (x1 + x2) / 2
-        center_y = (y1 + y2) / 2
-
+        x1, y1, x2, y2 = (int(v) for v in batch_result["bboxes"][0])
         return {
             "detected": True,
-            "bbox": (int(x1), int(y1), int(x2), int(y2)),
-            "confidence": confidence,
-            "center": (int(center_x), int(center_y)),
+            "bbox": (x1, y1, x2, y2),
+            "confidence": float(batch_result["confidences"][0]),
+            "center": (int((x1 + x2) / 2), int((y1 + y2) / 2)),
         }
 
+    def detect_batch(
+        self, frames: list[np.ndarray], batch_size: int = DETECT_BATCH_SIZE
+    ) -> dict[str, np.ndarray]:
+        """Detect the watermark on a list of frames, `batch_size` frames per forward.
+
+        Returns a dict of arrays aligned with `frames`:
+            detected: (N,) bool
+            bboxes: (N, 4) int32 xyxy, zeros where nothing was detected
+            confidences: (N,) float32, nan where nothing was detected
+        """
+        num_frames = len(frames)
+        detected = np.zeros(num_frames, dtype=bool)
+        bboxes = np.zeros((num_frames, 4), dtype=np.int32)
+        confidences = np.full(num_frames, np.nan, dtype=np.float32)
+
+        for start in range(0, num_frames, batch_size):
+            chunk = frames[start : start + batch_size]
+            if self.use_roi:
+                hit_idxs, top_boxes = self._predict_roi(chunk)
+            else:
+                hit_idxs, top_boxes = self._predict(chunk)
+            if len(hit_idxs) == 0:
+                continue
+            frame_idxs = start + hit_idxs
+            detected[frame_idxs] = True
+            bboxes[frame_idxs] = top_boxes[:, :4].astype(np.int32)
+            confidences[frame_idxs] = top_boxes[:, 4]
+
+        return {"detected": detected, "bboxes": bboxes, "confidences": confidences}
+
+    def _predict(
+        self, frames: list[np.ndarray], imgsz: tuple[int, int] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Run one forward over `frames`.
+
+        Returns the indexes of the frames with a detection and their top box as
+        rows of (x1, y1, x2, y2, confidence, class).
+        """
+        if self.backend == "onnx":
+            return self.model.predict(frames, imgsz)
+        kwargs = {"imgsz": imgsz} if imgsz is not None else {}
+        results = self.model(frames, verbose=False, **kwargs)
+        # boxes are sorted by confidence, keep the first one of each frame and
+        # move them to the host in a single transfer
+        hit_idxs = [i for i, result in enumerate(results) if len(result.boxes)]
+        if not hit_idxs:
+            return np.empty(0, dtype=int), np.empty((0, 6), dtype=np.float32)
+        top_boxes = (
+            torch.stack([results[i].boxes.data[0] for i in hit_idxs]).cpu().numpy()
+        )
+        return np.asarray(hit_idxs), top_boxes
+
+    def _predict_roi(self, frames: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        height, width = frames[0].shape[:2]
+        # keep the scale the model sees on a full frame, so the watermark has the
+        # same size in pixels inside a crop as during training
+        scale = self.imgsz / max(height, width)
+
+        pending = np.arange(len(frames))
+        hit_idxs = []
+        top_boxes = []
+
+        def _run(region: tuple[int, int, int, int] | None, learn: bool):
+            nonlocal pending
+            if len(pending) == 0:
+                return
+            if region is None:
+                x1, y1 = 0, 0
+                hits, boxes = self._predict([frames[i] for i in pending])
+            else:
+                x1, y1, x2, y2 = region
+                hits, boxes = self._predict(
+                    [frames[i][y1:y2, x1:x2] for i in pending],
+                    imgsz=roi_inference_size(region, scale),
+                )
+            if len(hits) == 0:
+                return
+            # map the boxes back to full frame coordinates
+            boxes[:, [0, 2]] += x1
+            boxes[:, [1, 3]] += y1
+            if region is not None:
+                # a watermark crossing the crop border is only detected in part,
+                # leave those frames to the next region or the full frame
+                whole = np.array(
+                    [
+                        not touches_inner_border(
+                            box[:4], region, width, height, DETECT_ROI_BORDER_MARGIN
+                        )
+                        for box in boxes
+                    ]
+                )
+                hits, boxes = hits[whole], boxes[whole]
+                if len(hits) == 0:
+                    return
+            hit_idxs.append(pending[hits])
+            top_boxes.append(boxes)
+            pending = np.delete(pending, hits)
+            if learn:
+                for box in boxes:
+                    bbox = tuple(int(v) for v in box[:4])
+                    if any(bbox_inside(bbox, it) for it in self.learned_rois):
+                        continue
+                    roi = expand_bbox(bbox, DETECT_ROI_EXPAND, width, height)
+                    self.learned_rois = merge_rois(
+                        self.learned_rois, roi, DETECT_MAX_LEARNED_ROIS
+                    )
+                    logger.debug(f"Learned watermark roi: {roi}")
+
+        for roi in list(self.learned_rois):
+            _run(roi, learn=False)
+        for roi in self.rois:
+            _run(roi_to_pixels(roi, width, height), learn=True)
+        _run(None, learn=True)
+
+        if not hit_idxs:
+            return np.empty(0, dtype=int), np.empty((0, 6), dtype=np.float32)
+        return np.concatenate(hit_idxs), np.concatenate(top_boxes)
+
 
 if __name__ == "__main__":
     from pathlib import Path